@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import struct
+import argparse
+import resource
+import tracemalloc
+import tempfile
+import random
+import multiprocessing
+import zlib
+import pyzstd
+import linear
+import nbt_scanner
+
+class CustomArgumentParser(argparse.ArgumentParser):
+    def error(self, _):
+        self.print_help()
+        sys.exit(1)
+
+def write_region_linear_joined(destination_filename, region, compression_level=1):
+    # The writer as it was before streaming, kept as a baseline
+    inside_header = []
+    newest_timestamp = 0
+    chunk_count = 0
+
+    for i in range(32**2):
+        if region.chunks[i] != None:
+            inside_header.append(struct.pack(">II", len(region.chunks[i].raw_chunk), region.timestamps[i]))
+            newest_timestamp = max(region.timestamps[i], newest_timestamp)
+            chunk_count += 1
+        else:
+            inside_header.append(b"\x00" * 8)
+
+    chunks = []
+    for i in range(32**2):
+        if region.chunks[i] != None:
+            chunks.append(region.chunks[i].raw_chunk)
+        else:
+            chunks.append(b"")
+
+    complete_region = b''.join(inside_header) + b''.join(chunks)
+    option = {pyzstd.CParameter.compressionLevel : compression_level,
+                pyzstd.CParameter.checksumFlag : 1}
+    complete_region = pyzstd.compress(complete_region, level_or_option=option)
+
+    preheader = struct.pack(">QBQbhI", linear.LINEAR_SIGNATURE, linear.LINEAR_VERSION, newest_timestamp, compression_level, chunk_count, len(complete_region))
+    footer = struct.pack(">Q", linear.LINEAR_SIGNATURE)
+    final_region_file = preheader + b"\x00" * 8 + complete_region + footer
+
+    with open(destination_filename + ".wip", "wb") as f:
+        f.write(final_region_file)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(destination_filename + ".wip", destination_filename)
+
+WRITERS = {
+    "joined": write_region_linear_joined,
+    "streaming": lambda destination_filename, region, compression_level: linear.write_region_linear(destination_filename, region, compression_level, version=linear.LINEAR_VERSION),
+}
+
+def measure_write(writer_name, file_path, compression_level, repeats, result_queue):
+    # Runs in a fresh process so ru_maxrss only reflects this writer
+    region = linear.open_region_linear(file_path)
+    writer = WRITERS[writer_name]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with tempfile.TemporaryDirectory() as tmp:
+        destination = os.path.join(tmp, os.path.basename(file_path))
+        tracemalloc.start()
+        start = time.time()
+        for _ in range(repeats):
+            writer(destination, region, compression_level=compression_level)
+        elapsed = (time.time() - start) / repeats
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size = os.path.getsize(destination)
+
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result_queue.put((elapsed, peak, max(0, rss_after - rss_before) * 1024, size))
+
+def run_isolated(target, *args):
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(target=target, args=args + (result_queue,))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+def benchmark_write(args):
+    print("%-10s %10s %14s %14s %12s" % ("writer", "time ms", "py peak MB", "rss growth MB", "size MB"))
+    for file_path in args.files:
+        print(file_path)
+        for writer_name in WRITERS:
+            elapsed, peak, rss_growth, size = run_isolated(measure_write, writer_name, file_path, args.compression_level, args.repeats)
+            print("%-10s %10.1f %14.1f %14.1f %12.2f" % (writer_name, elapsed * 1000, peak / 2**20, rss_growth / 2**20, size / 2**20))
+
+def benchmark_chunk_compression(args):
+    # What generating an .mca costs for each chunk compression type, and what opening it costs the reader
+    print("%-6s %12s %12s %12s" % ("type", "write ms", "open ms", "size MB"))
+    for file_path in args.files:
+        print(file_path)
+        region = linear.open_region_linear(file_path)
+        with tempfile.TemporaryDirectory() as tmp:
+            destination = os.path.join(tmp, "r.%d.%d.mca" % (region.region_x, region.region_z))
+            for name, compression_type in linear.CHUNK_COMPRESSION_TYPES.items():
+                start = time.time()
+                for _ in range(args.repeats):
+                    linear.write_region_anvil(destination, region, compression_level=args.compression_level, compression_type=compression_type)
+                write_time = (time.time() - start) / args.repeats
+
+                start = time.time()
+                for _ in range(args.repeats):
+                    linear.open_region_anvil(destination)
+                open_time = (time.time() - start) / args.repeats
+                print("%-6s %12.1f %12.1f %12.2f" % (name, write_time * 1000, open_time * 1000, os.path.getsize(destination) / 2**20))
+
+def benchmark_seekable(args):
+    # Size and latency of Linear version 1 against version 2 with different bucket grids
+    layouts = [("v1", linear.LINEAR_VERSION, 0)] + [("v2 grid %d" % grid_size, linear.LINEAR_VERSION_BUCKETED, grid_size) for grid_size in args.grid_sizes]
+    print("%-12s %10s %12s %14s %14s" % ("layout", "size MB", "open ms", "open %d thr ms" % args.threads, "1 chunk ms"))
+    rng = random.Random(0)
+    for file_path in args.files:
+        print(file_path)
+        region = linear.open_region_linear(file_path)
+        present = [chunk for chunk in region.chunks if chunk is not None]
+        samples = [rng.choice(present) for _ in range(args.samples)] if present else []
+        with tempfile.TemporaryDirectory() as tmp:
+            destination = os.path.join(tmp, os.path.basename(file_path))
+            for name, version, grid_size in layouts:
+                linear.write_region_linear(destination, region, compression_level=args.compression_level, version=version, grid_size=grid_size or linear.BUCKET_GRID_SIZE)
+
+                start = time.time()
+                for _ in range(args.repeats):
+                    linear.open_region_linear(destination, compact=False) # Every bucket, version 2 would otherwise only read the index
+                open_time = (time.time() - start) / args.repeats
+
+                start = time.time()
+                for _ in range(args.repeats):
+                    linear.open_region_linear(destination, compact=False, threads=args.threads)
+                threaded_open_time = (time.time() - start) / args.repeats
+
+                start = time.time()
+                for chunk in samples:
+                    linear.read_chunk_linear(destination, chunk.x, chunk.z)
+                chunk_time = (time.time() - start) / len(samples) if samples else 0
+
+                # Chunks edited in place have to end up in the file, not the bucket they were read from
+                edited = linear.open_region_linear(destination)
+                for chunk in edited.chunks:
+                    if chunk is not None:
+                        chunk.raw_chunk = bytes(chunk.raw_chunk) + b"\x00"
+                linear.write_region_linear(destination + ".edited", edited, compression_level=args.compression_level)
+                reread = linear.open_region_linear(destination + ".edited")
+                if reread.version != version or [bytes(chunk.raw_chunk) if chunk else None for chunk in reread.chunks] != [bytes(chunk.raw_chunk) + b"\x00" if chunk else None for chunk in region.chunks]:
+                    raise Exception("In place edits lost by %s" % name)
+                print("%-12s %10.2f %12.1f %14.1f %14.2f" % (name, os.path.getsize(destination) / 2**20, open_time * 1000, threaded_open_time * 1000, chunk_time * 1000))
+
+def nbtlib_value(tag):
+    if isinstance(tag, str):
+        return str(tag)
+    if isinstance(tag, (int, float)):
+        return tag.real
+    return bytes(tag.__class__.__name__, "ascii")
+
+def benchmark_nbt(args):
+    # Extracting a few fields with the streaming scanner against parsing the whole tree with nbtlib
+    scanner = nbt_scanner.NbtScanner(args.paths)
+    print("%-8s %10s %14s %14s %10s" % ("chunks", "MB", "nbtlib ms", "scanner ms", "speedup"))
+    for file_path in args.files:
+        print(file_path)
+        region = linear.open_region_linear(file_path)
+        chunks = [chunk for chunk in region.chunks if chunk is not None]
+        if not chunks:
+            continue
+
+        start = time.time()
+        for chunk in chunks:
+            nbt = chunk.as_nbtlib()
+            expected = {}
+            for path in args.paths:
+                tag = nbt
+                for key in path.split("."):
+                    tag = tag.get(key) if hasattr(tag, "get") else None
+                if tag is not None:
+                    expected[path] = nbtlib_value(tag)
+        nbtlib_time = time.time() - start
+
+        start = time.time()
+        for chunk in chunks:
+            scanner.scan(chunk.raw_chunk)
+        scanner_time = time.time() - start
+
+        # Same answers as nbtlib, compounds, lists and arrays only by presence
+        for chunk in chunks:
+            nbt = chunk.as_nbtlib()
+            for path, value in scanner.scan(chunk.raw_chunk).items():
+                tag = nbt
+                for key in path.split("."):
+                    tag = tag[key]
+                if isinstance(value, (int, float, str)) and value != nbtlib_value(tag):
+                    raise Exception("Scanner disagrees with nbtlib on %s: %r, %r" % (path, value, tag))
+
+        size = sum(len(chunk.raw_chunk) for chunk in chunks)
+        print("%-8d %10.2f %14.1f %14.1f %9.0fx" % (len(chunks), size / 2**20, nbtlib_time * 1000, scanner_time * 1000, nbtlib_time / max(scanner_time, 1e-9)))
+
+if __name__ == "__main__":
+    parser = CustomArgumentParser(description="Benchmark region file reading and writing")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    write_parser = subparsers.add_parser("write", help="Compare peak memory and wall time of the Linear writers")
+    write_parser.add_argument("-c", "--compression-level", type=int, default=6, help="Zstd compression level (default: 6)")
+    write_parser.add_argument("-r", "--repeats", type=int, default=3, help="Writes per measurement (default: 3)")
+    write_parser.add_argument("files", nargs="+", help=".linear region files to rewrite")
+    write_parser.set_defaults(func=benchmark_write)
+
+    chunk_compression_parser = subparsers.add_parser("chunk-compression", help="Compare .mca write and open latency of the chunk compression types")
+    chunk_compression_parser.add_argument("-c", "--compression-level", type=int, default=zlib.Z_BEST_SPEED, help="Zlib compression level (default: 1)")
+    chunk_compression_parser.add_argument("-r", "--repeats", type=int, default=3, help="Writes and opens per measurement (default: 3)")
+    chunk_compression_parser.add_argument("files", nargs="+", help=".linear region files to convert")
+    chunk_compression_parser.set_defaults(func=benchmark_chunk_compression)
+
+    seekable_parser = subparsers.add_parser("seekable", help="Compare size, open and single chunk latency of Linear versions 1 and 2")
+    seekable_parser.add_argument("-c", "--compression-level", type=int, default=6, help="Zstd compression level (default: 6)")
+    seekable_parser.add_argument("-r", "--repeats", type=int, default=3, help="Opens per measurement (default: 3)")
+    seekable_parser.add_argument("-t", "--threads", type=int, default=multiprocessing.cpu_count(), help="Threads for the parallel open (default: number of CPUs)")
+    seekable_parser.add_argument("-g", "--grid-sizes", type=int, nargs="+", default=[4, 8, 16], help="Version 2 bucket grids to try (default: 4 8 16)")
+    seekable_parser.add_argument("-s", "--samples", type=int, default=100, help="Random chunks to read one by one (default: 100)")
+    seekable_parser.add_argument("files", nargs="+", help=".linear region files to rewrite")
+    seekable_parser.set_defaults(func=benchmark_seekable)
+
+    nbt_parser = subparsers.add_parser("nbt", help="Compare extracting chunk fields with nbt_scanner against nbtlib")
+    nbt_parser.add_argument("-p", "--paths", type=lambda value: value.split(","), default=list(nbt_scanner.CHUNK_FIELDS), help="Comma separated dotted NBT paths to extract (default: %s)" % ",".join(nbt_scanner.CHUNK_FIELDS))
+    nbt_parser.add_argument("files", nargs="+", help=".linear region files to read")
+    nbt_parser.set_defaults(func=benchmark_nbt)
+
+    args = parser.parse_args()
+    args.func(args)
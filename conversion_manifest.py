@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import hashlib
+
+class ConversionManifest:
+    # Remembers what every destination file was converted from, so incremental runs only need to stat the source directory
+    FILE_NAME = ".conversion_manifest.sqlite"
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, destination_dir):
+        self.path = os.path.join(destination_dir, self.FILE_NAME)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, conversion_mode TEXT NOT NULL, source_size INTEGER NOT NULL, source_mtime_ns INTEGER NOT NULL, source_hash TEXT, destination_size INTEGER NOT NULL)")
+        self.uncommitted = 0
+
+    def load(self):
+        entries = {}
+        for name, conversion_mode, source_size, source_mtime_ns, source_hash, destination_size in self.db.execute("SELECT name, conversion_mode, source_size, source_mtime_ns, source_hash, destination_size FROM files"):
+            entries[name] = (conversion_mode, source_size, source_mtime_ns, source_hash, destination_size)
+        return entries
+
+    def record(self, name, conversion_mode, source_size, source_mtime_ns, source_hash, destination_size):
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", (name, conversion_mode, source_size, source_mtime_ns, source_hash, destination_size))
+        self.uncommitted += 1
+        if self.uncommitted >= self.COMMIT_INTERVAL: # Keep progress if the run gets interrupted
+            self.commit()
+
+    def forget(self, name):
+        self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+        self.uncommitted += 1
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+def hash_file(file_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def is_unchanged(entry, conversion_mode, source_size, source_mtime_ns):
+    return entry is not None and entry[0] == conversion_mode and entry[1] == source_size and entry[2] == source_mtime_ns
@@ -5,86 +5,229 @@ import os
 import os.path
 import argparse
 import zlib
-from glob import glob
-from linear import open_region_linear, write_region_anvil, open_region_anvil, write_region_linear
-from multiprocessing import Pool, cpu_count, Manager
+from linear import open_region_linear, write_region_anvil, open_region_anvil, write_region_linear, iter_chunks_linear, iter_chunks_anvil, write_region_anvil_streaming, write_region_linear_streaming, load_dictionary, CHUNK_COMPRESSION_TYPES
+from conversion_manifest import ConversionManifest, hash_file, is_unchanged
+from multiprocessing import Pool, cpu_count, Value
 from tqdm import tqdm
 
+queued_files = None
+zstd_dict = None
+
+def init_worker(queued_files_counter, dictionary_path):
+    global queued_files, zstd_dict
+    queued_files = queued_files_counter
+    if dictionary_path:
+        zstd_dict = load_dictionary(dictionary_path)
+
+def threads_for_file(zstd_workers, threads):
+    if zstd_workers != "auto":
+        return int(zstd_workers)
+    # Once fewer files wait to start than there are threads, processes run out of work. The files that start then split
+    # the CPU budget between them, so the tail of a conversion uses the cores the finished files left idle
+    with queued_files.get_lock():
+        queued = queued_files.value
+    workers = threads // max(1, min(threads, queued + 1))
+    return workers if workers > 1 else 0
+
+def zstd_workers_type(value):
+    if value == "auto":
+        return value
+    return int(value)
+
 class CustomArgumentParser(argparse.ArgumentParser):
     def error(self, _):
         self.print_help()
         sys.exit(1)
 
 def convert_file(args):
-    source_file, conversion_mode, destination_dir, compression_level, converted_counter, skipped_counter, log = args
-
-    os.makedirs(destination_dir, exist_ok=True)
+    with queued_files.get_lock():
+        queued_files.value -= 1
+    return (args[0],) + convert_single_file(*args)
 
+def destination_path(source_file, conversion_mode, destination_dir):
     source_filename = os.path.basename(source_file)
-    destination_file = os.path.join(destination_dir, source_filename).rpartition(".")[0] + (".mca" if conversion_mode == "linear2mca" else ".linear")
+    return os.path.join(destination_dir, source_filename).rpartition(".")[0] + (".mca" if conversion_mode == "linear2mca" else ".linear")
 
-    convert = False
-    try:
-        mtime_destination = os.path.getmtime(destination_file)
-        mtime_source = os.path.getmtime(source_file)
-        if mtime_destination != mtime_source:
-            convert = True
-    except FileNotFoundError:
-        convert = True
+def convert_single_file(source_file, source_size, source_mtime, in_manifest, conversion_mode, destination_dir, compression_level, chunk_compression, linear_version, streaming, zstd_workers, threads, log):
+    destination_file = destination_path(source_file, conversion_mode, destination_dir)
+
+    if source_size == 0: # Nothing to convert, recorded without a destination so incremental runs count it as done
+        return "skipped", source_size, None, 0
 
-    source_size = os.path.getsize(source_file)
-    if not convert or source_size == 0:
-        skipped_counter.value += 1
-        return
+    if not in_manifest:
+        # Files converted before the manifest existed are adopted if their mtime still matches
+        try:
+            st = os.stat(destination_file)
+            if st.st_mtime == source_mtime:
+                return "skipped", source_size, None, st.st_size
+        except FileNotFoundError:
+            pass
 
     try:
-        if conversion_mode == "linear2mca":
-            region = open_region_linear(source_file)
-            write_region_anvil(destination_file, region, compression_level=zlib.Z_DEFAULT_COMPRESSION)
+        file_threads = threads_for_file(zstd_workers, threads)
+        if streaming: # One chunk in memory at a time, for regions that don't fit in memory
+            if conversion_mode == "linear2mca":
+                write_region_anvil_streaming(destination_file, iter_chunks_linear(source_file, zstd_dict), source_mtime, compression_level=zlib.Z_DEFAULT_COMPRESSION, compression_type=CHUNK_COMPRESSION_TYPES[chunk_compression])
+            else:
+                write_region_linear_streaming(destination_file, iter_chunks_anvil(source_file), source_mtime, compression_level=compression_level, workers=file_threads, zstd_dict=zstd_dict)
+        elif conversion_mode == "linear2mca":
+            region = open_region_linear(source_file, zstd_dict=zstd_dict, threads=file_threads)
+            write_region_anvil(destination_file, region, compression_level=zlib.Z_DEFAULT_COMPRESSION, threads=file_threads, compression_type=CHUNK_COMPRESSION_TYPES[chunk_compression])
         else:
-            region = open_region_anvil(source_file)
-            write_region_linear(destination_file, region, compression_level=compression_level)
+            region = open_region_anvil(source_file, threads=file_threads)
+            write_region_linear(destination_file, region, compression_level=compression_level, workers=file_threads, zstd_dict=zstd_dict, version=linear_version)
 
         destination_size = os.path.getsize(destination_file)
+        source_hash = hash_file(source_file)
 
         if log:
             print(source_file, "converted, compression %3d%%" % (100 * destination_size / source_size))
-        converted_counter.value += 1
+        return "converted", source_size, source_hash, destination_size
     except Exception:
         import traceback
         traceback.print_exc()
         print("Error with region file", source_file)
+        return "error", source_size, None, None
+
+def scan_source_files(source_dir, extension):
+    # Largest files first (LPT scheduling), so a few huge spawn regions don't end up running alone at the end
+    source_files = []
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(extension) and entry.is_file():
+                st = entry.stat()
+                source_files.append((entry.path, st.st_size, st.st_mtime, st.st_mtime_ns))
+    source_files.sort(key=lambda source_file: source_file[1], reverse=True)
+    return source_files
+
+def verify_file(args):
+    source_file, source_hash = args
+    try:
+        return source_file, hash_file(source_file) == source_hash
+    except FileNotFoundError:
+        return source_file, False
+
+def verify_manifest(manifest, source_files, conversion_mode, manifest_mode, destination_dir, processes):
+    entries = manifest.load()
+    sources = dict((os.path.basename(source_file), (source_file, source_size, source_mtime_ns)) for source_file, source_size, _, source_mtime_ns in source_files)
+    drift = []
+    to_hash = []
+
+    for name, entry in sorted(entries.items()):
+        if name not in sources:
+            drift.append((name, "source file is gone"))
+            continue
+        source_file, source_size, source_mtime_ns = sources[name]
+        if not is_unchanged(entry, manifest_mode, source_size, source_mtime_ns):
+            drift.append((name, "source changed since conversion"))
+            continue
+        if source_size == 0:
+            continue
+        try:
+            destination_size = os.path.getsize(destination_path(source_file, conversion_mode, destination_dir))
+            if destination_size != entry[4]:
+                drift.append((name, "destination size %d, expected %d" % (destination_size, entry[4])))
+                continue
+        except FileNotFoundError:
+            drift.append((name, "destination file is gone"))
+            continue
+        if entry[3] is not None:
+            to_hash.append((source_file, entry[3]))
+
+    for name in sorted(set(sources) - set(entries)):
+        drift.append((name, "not in manifest"))
+
+    with Pool(processes) as pool:
+        for source_file, matches in tqdm(pool.imap_unordered(verify_file, to_hash), total=len(to_hash), desc="Hashing source files"):
+            if not matches:
+                drift.append((os.path.basename(source_file), "source content changed with the same size and mtime"))
+
+    for name, reason in drift:
+        print(name, "-", reason)
+        if name in entries:
+            manifest.forget(name) # The next conversion run picks it up again
+    print(f"Manifest verification complete: {len(entries)} entries, {len(drift)} drifted")
+    return len(drift) == 0
 
 if __name__ == "__main__":
     parser = CustomArgumentParser(description="Convert region files between Anvil and Linear format")
     parser.add_argument("conversion_mode", choices=["mca2linear", "linear2mca"], help="Conversion direction: mca2linear or linear2mca")
     parser.add_argument("-t", "--threads", type=int, default=cpu_count(), help="Number of threads (default: number of CPUs)")
     parser.add_argument("-c", "--compression-level", type=int, default=6, help="Zstd compression level (default: 6)")
+    parser.add_argument("--chunk-compression", choices=list(CHUNK_COMPRESSION_TYPES), default="zlib", help="Compression of chunks in written .mca files for linear2mca, none and lz4 need a server that understands them (default: zlib)")
+    parser.add_argument("--linear-version", type=int, choices=[1, 2], default=1, help="Linear version written by mca2linear, 2 splits regions into separately compressed buckets for random access (default: 1)")
+    parser.add_argument("-z", "--zstd-workers", type=zstd_workers_type, default="auto", help="Zstd and zlib threads per file, 'auto' gives the files that start last the cores of the finished ones (default: auto)")
+    parser.add_argument("-s", "--streaming", action='store_true', help="Convert one chunk at a time instead of whole regions in memory, for huge regions on small machines. Slower, and mca2linear only writes Linear version 1")
+    parser.add_argument("-d", "--dictionary", help="Zstd dictionary from train_dictionary.py to compress or decompress .linear files with")
+    parser.add_argument("--verify-manifest", action='store_true', help="Check the destination manifest against the source and destination files instead of converting")
     parser.add_argument("-l", "--log", action='store_true', help="Show a log of files instead of a progress bar")
     parser.add_argument("source_dir", help="Source directory containing region files")
     parser.add_argument("destination_dir", help="Destination directory to store converted region files")
 
     args = parser.parse_args()
+    if args.dictionary and args.linear_version != 1:
+        parser.error("Dictionaries are only supported by Linear version 1")
+    if args.streaming and args.linear_version != 1:
+        parser.error("Streaming conversion only writes Linear version 1")
 
     threads = args.threads
     compression_level = args.compression_level
     source_dir = args.source_dir
     destination_dir = args.destination_dir
     log = args.log
+    zstd_workers = args.zstd_workers
+    processes = threads
+    if zstd_workers != "auto" and zstd_workers > 1:
+        processes = max(1, threads // zstd_workers)
+
+    file_ext = ".linear" if args.conversion_mode == "linear2mca" else ".mca"
+    source_files = scan_source_files(source_dir, file_ext)
+    os.makedirs(destination_dir, exist_ok=True)
+    manifest = ConversionManifest(destination_dir)
+    # Switching the chunk compression or the Linear version has to reconvert everything
+    manifest_mode = args.conversion_mode
+    if args.conversion_mode == "linear2mca" and args.chunk_compression != "zlib":
+        manifest_mode += "-" + args.chunk_compression
+    if args.conversion_mode == "mca2linear" and args.linear_version != 1:
+        manifest_mode += "-v%d" % args.linear_version
+
+    if args.verify_manifest:
+        healthy = verify_manifest(manifest, source_files, args.conversion_mode, manifest_mode, destination_dir, processes)
+        manifest.close()
+        sys.exit(0 if healthy else 1)
+
+    entries = manifest.load()
+    counters = {"converted": 0, "skipped": 0, "error": 0}
+    changed_files = []
+    for source_file, source_size, source_mtime, source_mtime_ns in source_files:
+        # A destination deleted by hand gets converted again, the manifest alone would still call it unchanged
+        if is_unchanged(entries.get(os.path.basename(source_file)), manifest_mode, source_size, source_mtime_ns) and (source_size == 0 or os.path.exists(destination_path(source_file, args.conversion_mode, destination_dir))):
+            counters["skipped"] += 1
+        else:
+            changed_files.append((source_file, source_size, source_mtime, source_mtime_ns))
+    source_mtimes_ns = dict((source_file, source_mtime_ns) for source_file, _, _, source_mtime_ns in changed_files)
 
-    file_ext = "*.linear" if args.conversion_mode == "linear2mca" else "*.mca"
-    file_list = glob(os.path.join(source_dir, file_ext))
-    print("Found", len(file_list), "region files to convert")
+    total_size = sum(source_size for _, source_size, _, _ in changed_files)
+    print("Found", len(source_files), "region files,", len(changed_files), "to convert, %.1f MB" % (total_size / 2**20))
 
-    with Manager() as manager:
-        converted_counter = manager.Value("i", 0)
-        skipped_counter = manager.Value("i", 0)
-        pool = Pool(threads)
+    queued_files_counter = Value("i", len(changed_files))
+    with Pool(processes, initializer=init_worker, initargs=(queued_files_counter, args.dictionary)) as pool:
         progress_bar = None
         if not log:
-            progress_bar = tqdm(total=len(file_list), desc="Converting files")
-        for _ in pool.imap_unordered(convert_file, [(file, args.conversion_mode, destination_dir, compression_level, converted_counter, skipped_counter, log) for file in file_list]):
+            # Weighted by bytes, so the ETA doesn't jump when the big files finish
+            progress_bar = tqdm(total=total_size, desc="Converting files", unit="B", unit_scale=True, unit_divisor=1024)
+        tasks = [(source_file, source_size, source_mtime, os.path.basename(source_file) in entries, args.conversion_mode, destination_dir, compression_level, args.chunk_compression, args.linear_version, args.streaming, zstd_workers, threads, log) for source_file, source_size, source_mtime, _ in changed_files]
+        for source_file, status, source_size, source_hash, destination_size in pool.imap_unordered(convert_file, tasks, chunksize=1):
+            counters[status] += 1
+            name = os.path.basename(source_file)
+            if destination_size is not None:
+                manifest.record(name, manifest_mode, source_size, source_mtimes_ns[source_file], source_hash, destination_size)
+            elif status == "error":
+                manifest.forget(name)
             if progress_bar:
-                progress_bar.update(1)
+                progress_bar.update(source_size)
         if progress_bar: progress_bar.close()
-        print(f"Conversion complete: {converted_counter.value} region files converted, {skipped_counter.value} region files skipped")
+    manifest.close()
+    print(f"Conversion complete: {counters['converted']} region files converted, {counters['skipped']} region files skipped")
+    if counters["error"]:
+        print(f"{counters['error']} region files failed to convert")
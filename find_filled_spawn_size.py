@@ -8,10 +8,8 @@ class FinishedException(Exception):
 
 def verify_region_file_is_fully_filled(file_path):
     if not os.path.isfile(file_path): return False
-    region = linear.open_region_linear(file_path)
-    for chunk in region.chunks:
-        if chunk == None: return False
-    return True
+    header = linear.read_linear_header(file_path)
+    return header.chunk_count == linear.REGION_DIMENSION * linear.REGION_DIMENSION
 
 def verify(path_to_files, dx, dz):
     file_name = f"r.{dx}.{dz}.linear"
@@ -2,9 +2,7 @@
 import os
 import sys
 import argparse
-import shutil
-from time import sleep
-from tqdm import tqdm
+from tiering import Throttle, add_tiering_arguments, is_same_file, swap_to_symlink, clean_temporaries, run_tasks
 
 class CustomArgumentParser(argparse.ArgumentParser):
     def error(self, message):
@@ -12,10 +10,24 @@ class CustomArgumentParser(argparse.ArgumentParser):
         self.print_help()
         sys.exit(1)
 
-def create_symlink(source, destination):
-    # create a symlink from source to destination
-    if not os.path.exists(destination):
-        os.symlink(source, destination)
+def plan_swaps(server_dir, storage_dir):
+    # Only files whose storage copy matches, the swap checks again right before it happens
+    tasks = []
+    ignored = 0
+    with os.scandir(server_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".linear") or entry.is_symlink() or not entry.is_file():
+                continue
+            try:
+                storage_stat = os.stat(os.path.join(storage_dir, entry.name))
+            except FileNotFoundError:
+                ignored += 1
+                continue
+            if is_same_file(entry.stat(), storage_stat):
+                tasks.append((entry.name, storage_stat.st_size))
+            else:
+                ignored += 1
+    return tasks, ignored
 
 def main(args):
     server_dir = args.server_dir.rstrip(os.sep)
@@ -24,43 +36,35 @@ def main(args):
         raise ValueError(f"Server directory {server_dir} does not exist or is not a directory.")
     if not os.path.isdir(storage_dir):
         raise ValueError(f"Storage directory {storage_dir} does not exist or is not a directory.")
+    clean_temporaries(server_dir)
     print(f"Preparing a file list from {server_dir}, this can take a minute.")
-    server_files = [f for f in os.listdir(server_dir)]
-    print(f"Done.")
-    progress_bar = tqdm(total=len(server_files), desc="Processing files", disable=args.verbose)
+    tasks, ignored = plan_swaps(server_dir, storage_dir)
+    print(f"Done. {len(tasks)} files to move to {storage_dir}, %.1f MB" % (sum(size for _, size in tasks) / 2**20))
 
-    for i, file_name in enumerate(server_files):
-        if file_name.endswith(".linear") and not os.path.islink(os.path.join(server_dir, file_name)):
-            moved = False
-            server_file_path = os.path.join(server_dir, file_name)
-            storage_file_path = os.path.join(storage_dir, file_name)
-            if os.path.exists(storage_file_path) and os.path.isfile(storage_file_path):
-                server_file_stat = os.stat(server_file_path)
-                storage_file_stat = os.stat(storage_file_path)
-                if server_file_stat.st_mtime == storage_file_stat.st_mtime and server_file_stat.st_size == storage_file_stat.st_size:
-                    tmp_file_path = server_file_path + ".tmp"
-                    create_symlink(storage_file_path, tmp_file_path)
-                    tmp_file_stat = os.stat(tmp_file_path)
-                    if tmp_file_stat.st_mtime == storage_file_stat.st_mtime and tmp_file_stat.st_size == storage_file_stat.st_size:
-                        shutil.move(tmp_file_path, server_file_path)
-                        moved = True
-                        if args.verbose: print(f"{i}/{len(server_files)} - moved {file_name} to {storage_dir}")
-                        if args.slow: sleep(args.slow)
+    # Freed bytes count against --max-mbps, the filesystem has to discard them after all
+    throttle = Throttle(args.max_mbps, args.max_iops)
+    def swap(task):
+        if swap_to_symlink(os.path.join(server_dir, task[0]), os.path.join(storage_dir, task[0]), throttle):
+            return "moved"
+        return "changed"
+    results = run_tasks(tasks, swap, args.workers, desc="Processing files", verbose=args.verbose)
 
-            if moved == False and args.verbose:
-                print(f"{i}/{len(server_files)} - ignoring {file_name}")
-        if args.slow: sleep(args.slow / 100) # Slow down somewhat even if just looping
-        progress_bar.update(1)
-    progress_bar.close()
+    print(f"Moved region files: {results['moved']}")
+    print(f"Changed since the file list, ignored: {results['changed']}")
+    print(f"Without a matching storage copy, ignored: {ignored}")
+    if results["error"]:
+        print(f"Failed region files: {results['error']}")
+    if results["interrupted"]:
+        print("Interrupted, run again to move the rest")
 
 if __name__ == "__main__":
     parser = CustomArgumentParser(description="Free space from server and create symlinks to storage.")
     parser.add_argument("server_dir", help="minecraft server's region file directory (SSD)")
     parser.add_argument("storage_dir", help="region file storage directory (HDD)")
     parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
-    parser.add_argument("-s", "--slow", type=float, metavar="SECONDS", help="wait SECONDS seconds after each successful move")
+    add_tiering_arguments(parser)
     args = parser.parse_args()
     try:
         main(args)
     except ValueError as e:
-        parser.error(str(e))
\ No newline at end of file
+        parser.error(str(e))
@@ -27,34 +27,515 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
-import sys
 import errno
 import time
 import zlib
+import struct
+import threading
+import json
+import argparse
+import traceback
+import hashlib
 
 from fuse import FUSE, FuseOSError, Operations, fuse_get_context
-from collections import OrderedDict
-from linear import open_region_linear, write_region_anvil_to_bytes
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from bisect import bisect_right
+from array import array
+from tiering import parse_size
+from linear import Chunk, Region, BucketedChunks, open_region_linear, read_linear_header, write_region_linear, write_region_anvil_to_bytes, compress_chunk, decompress_chunk, lz4_block_bound, REGION_DIMENSION, COMPRESSION_TYPE_ZLIB, COMPRESSION_TYPE_LZ4, EXTERNAL_FILE_FLAG, CHUNK_COMPRESSION_TYPES, HEADER_SIZE
+
+SECTOR = 4096
+STAT_KEYS = ('st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid')
+
+def zlib_bound(size):
+    # Same as zlib's compressBound(), no chunk can compress to more than this
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+def sectors_for(size):
+    return (size + 5 + SECTOR - 1) // SECTOR
+
+def worst_case_sectors(size, compression_type):
+    if compression_type == COMPRESSION_TYPE_ZLIB:
+        return sectors_for(zlib_bound(size))
+    if compression_type == COMPRESSION_TYPE_LZ4:
+        return sectors_for(lz4_block_bound(size))
+    return sectors_for(size) # Uncompressed
+
+def mca_size_from_header(header, compression_type):
+    # Size of the LazyAnvilFile layout, or None if some chunk is too big for the worst case layout and has to be compressed first
+    sectors = 2
+    for size in header.sizes:
+        if size > 0:
+            if worst_case_sectors(size, compression_type) > 255:
+                return None
+            sectors += worst_case_sectors(size, compression_type)
+    return SECTOR * sectors
+
+class AnvilImage:
+    # An .mca served from some base image, with the server's writes landing in a sector overlay on top of it.
+    # Subclasses provide read_base(), the region the image was made from and region_bytes/image_bytes for memory accounting
+    def __init__(self, header, size):
+        self.header = header
+        self.size = size
+        self.base_size = size # Everything past this is zeros unless the server wrote there
+        self.lock = threading.RLock()
+        self.overlay = {} # sector -> bytearray(SECTOR)
+        self.dirty_sectors = set() # Sectors written since the last commit
+        self.committed_locations = struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), header, 0)
+        self.version = 0 # Bumped by every commit that changed the region
+        self.persisted_version = 0
+
+    def load_region(self):
+        return self.region
+
+    def close(self):
+        pass
+
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return b""
+        out = bytearray(end - offset)
+        self.read_base(out, offset, min(end, self.base_size))
+
+        if self.overlay:
+            with self.lock:
+                for sector in range(offset // SECTOR, (end - 1) // SECTOR + 1):
+                    data = self.overlay.get(sector)
+                    if data is not None:
+                        start, stop = max(offset, SECTOR * sector), min(end, SECTOR * (sector + 1))
+                        out[start - offset:stop - offset] = data[start - SECTOR * sector:stop - SECTOR * sector]
+
+        return bytes(out)
+
+    def write(self, offset, data):
+        with self.lock:
+            position = 0
+            while position < len(data):
+                sector, within = divmod(offset + position, SECTOR)
+                length = min(SECTOR - within, len(data) - position)
+                buffer = self.overlay.get(sector)
+                if buffer is None:
+                    buffer = bytearray(self.read(SECTOR * sector, SECTOR))
+                    buffer.extend(bytes(SECTOR - len(buffer)))
+                    self.overlay[sector] = buffer
+                buffer[within:within + length] = data[position:position + length]
+                self.dirty_sectors.add(sector)
+                position += length
+            self.size = max(self.size, offset + len(data))
+        return len(data)
+
+    def truncate(self, length):
+        with self.lock:
+            if length < self.size:
+                for sector in [sector for sector in self.overlay if SECTOR * sector >= length]:
+                    del self.overlay[sector]
+                sector, within = divmod(length, SECTOR)
+                if within:
+                    buffer = self.overlay.get(sector)
+                    if buffer is None:
+                        buffer = bytearray(self.read(SECTOR * sector, within))
+                        self.overlay[sector] = buffer
+                    buffer[within:] = bytes(SECTOR - within)
+                    self.dirty_sectors.add(sector)
+                self.base_size = min(self.base_size, length)
+            self.size = length
+
+    def is_clean(self):
+        return not self.dirty_sectors and self.persisted_version == self.version
+
+    def commit(self, directory):
+        # Turns the sectors written since the last commit back into raw chunks. Only chunks whose location moved or whose sectors
+        # were written get decompressed, everything else keeps the raw chunk it was loaded with. Returns True if the region changed
+        with self.lock:
+            if not self.dirty_sectors:
+                return False
+            region = self.load_region()
+            header = self.read(0, 2 * SECTOR)
+            locations = struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), header, 0)
+            timestamps = struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), header, SECTOR)
+            dirty_sectors = self.dirty_sectors
+
+            for i in range(REGION_DIMENSION * REGION_DIMENSION):
+                chunk_start, sector_count = locations[i] >> 8, locations[i] & 0xff
+                if locations[i] == self.committed_locations[i] and not any(sector in dirty_sectors for sector in range(chunk_start, chunk_start + sector_count)):
+                    continue
+                x, z = REGION_DIMENSION * region.region_x + i % 32, REGION_DIMENSION * region.region_z + i // 32
+                old_chunk = region.chunks[i]
+                if old_chunk is not None: # The replaced chunk no longer counts towards the entry
+                    self.region_bytes -= len(old_chunk.raw_chunk)
+                if chunk_start < 2 or sector_count == 0:
+                    region.chunks[i] = None
+                    continue
+                data = self.read(SECTOR * chunk_start, SECTOR * sector_count)
+                chunk_size, compression_type = struct.unpack_from(">IB", data, 0)
+                if compression_type & EXTERNAL_FILE_FLAG:
+                    raw_chunk = decompress_chunk(open(os.path.join(directory, "c.%d.%d.mcc" % (x, z)), "rb").read(), compression_type & ~EXTERNAL_FILE_FLAG)
+                else:
+                    raw_chunk = decompress_chunk(data[5:4 + chunk_size], compression_type)
+                region.chunks[i] = Chunk(raw_chunk, x, z)
+                self.region_bytes += len(raw_chunk)
+
+            region.timestamps = array('I', timestamps)
+            region.mtime = time.time()
+            self.committed_locations = locations
+            self.dirty_sectors = set()
+            self.version += 1
+            return True
+
+    def snapshot(self):
+        # A copy of the region as of now, the write-back thread encodes it while the server keeps writing
+        with self.lock:
+            region = self.load_region()
+            # Version 2 regions stay bucketed, so write-back keeps the version and reuses the buckets nobody wrote to
+            chunks = region.chunks.copy() if isinstance(region.chunks, BucketedChunks) else list(region.chunks)
+            region = Region(chunks, region.region_x, region.region_z, region.mtime, list(region.timestamps), region.version, region.grid_size)
+            return region, self.version
+
+    def memory_usage(self):
+        return self.region_bytes + self.image_bytes + len(self.header) + SECTOR * len(self.overlay)
+
+class LazyAnvilFile(AnvilImage):
+    # An .mca image with a fixed sector layout, chunks are only compressed once a read touches their sectors.
+    # Every chunk gets enough sectors for its worst case compressed size, so the layout is known without compressing anything.
+    def __init__(self, region, compression_level, compression_type):
+        self.region = region
+        self.compression_level = compression_level
+        self.compression_type = compression_type
+        self.images = {} # position in self.indices -> length prefix, compression type and compressed chunk
+        self.indices = []
+        self.chunk_offsets = []
+        self.sector_counts = []
+        self.region_bytes = HEADER_SIZE
+        self.image_bytes = 0
+
+        header = bytearray(2 * SECTOR)
+        free_sector = 2
+        for i in range(REGION_DIMENSION * REGION_DIMENSION):
+            chunk = region.chunks[i]
+            if chunk is None:
+                continue
+            self.region_bytes += len(chunk.raw_chunk)
+            sector_count = worst_case_sectors(len(chunk.raw_chunk), compression_type)
+            if sector_count > 255: # Too big for a worst case layout, compress it right away to find out the real size
+                image = self.compress_chunk(i)
+                sector_count = sectors_for(len(image) - 5)
+                if sector_count > 255:
+                    raise Exception("Chunk %d %d doesn't fit in a region file" % (chunk.x, chunk.z))
+                self.images[len(self.indices)] = image
+                self.image_bytes += len(image)
+            struct.pack_into(">I", header, i * 4, (free_sector << 8) | sector_count)
+            self.indices.append(i)
+            self.chunk_offsets.append(SECTOR * free_sector)
+            self.sector_counts.append(sector_count)
+            free_sector += sector_count
+        struct.pack_into(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), header, SECTOR, *region.timestamps)
+
+        super().__init__(bytes(header), SECTOR * free_sector)
+
+    def compress_chunk(self, i):
+        compressed = compress_chunk(self.region.chunks[i].raw_chunk, self.compression_type, self.compression_level)
+        return struct.pack(">IB", len(compressed) + 1, self.compression_type) + compressed
+
+    def chunk_image(self, k):
+        image = self.images.get(k)
+        if image is None:
+            # Two threads may race to compress the same chunk, both get identical bytes so that's harmless
+            image = self.compress_chunk(self.indices[k])
+            if self.images.setdefault(k, image) is image:
+                self.image_bytes += len(image)
+        return image
+
+    def read_base(self, out, offset, end):
+        if offset >= end:
+            return
+        if offset < len(self.header):
+            out[:min(end, len(self.header)) - offset] = self.header[offset:end]
+
+        k = max(0, bisect_right(self.chunk_offsets, offset) - 1)
+        while k < len(self.chunk_offsets) and self.chunk_offsets[k] < end:
+            chunk_start = self.chunk_offsets[k]
+            if chunk_start + SECTOR * self.sector_counts[k] > offset:
+                image = self.chunk_image(k)
+                start, stop = max(offset, chunk_start), min(end, chunk_start + len(image))
+                if start < stop: # Anything past the image is padding, already zeroed
+                    out[start - offset:stop - offset] = image[start - chunk_start:stop - chunk_start]
+            k += 1
 
-MCA_FILES_SIZE = 20 * 1024 * 1024
+class DiskAnvilFile(AnvilImage):
+    # An .mca from the disk cache, read with pread. The region is only decompressed if the server writes to it
+    def __init__(self, cache_file, path_linear):
+        self.path_linear = path_linear
+        self.region = None
+        self.region_bytes = 0
+        self.image_bytes = 0
+        self.fd = os.open(cache_file, os.O_RDONLY)
+        try:
+            size = os.fstat(self.fd).st_size
+            super().__init__(os.pread(self.fd, 2 * SECTOR, 0), size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def load_region(self):
+        with self.lock:
+            if self.region is None:
+                self.region = open_region_linear(self.path_linear)
+                self.region_bytes = sum(len(chunk.raw_chunk) for chunk in self.region.chunks if chunk is not None)
+            return self.region
+
+    def read_base(self, out, offset, end):
+        if offset < end:
+            data = os.pread(self.fd, end - offset, offset)
+            out[:len(data)] = data
+
+    def close(self):
+        os.close(self.fd)
+
+class DiskCache:
+    # Second tier under LinearFileCache. Generated .mca files are kept whole, named after the .linear path, mtime and size,
+    # so after a restart a hot region costs a pread instead of a decompress and recompress
+    def __init__(self, directory, cache_bytes, compression_type):
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self.compression_type = compression_type
+        self.lock = threading.Lock()
+        self.files = OrderedDict() # path key -> (file name, size), least recently used first
+        self.cached_bytes = 0
+        self.storing = set()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="disk-cache")
+        self.counters = {"disk_hits": 0, "disk_misses": 0, "disk_stores": 0, "disk_evictions": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".tmp"): # Left over from a store that got interrupted
+                    os.unlink(entry.path)
+                elif entry.name.endswith(".mca"):
+                    st = entry.stat()
+                    existing.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(existing): # Accesses touch the mtime, so this restores the LRU order
+            key = name.split("-")[0]
+            stale = self.files.pop(key, None)
+            if stale is not None: # A crash between storing the new version and unlinking the old one, the older file goes
+                os.unlink(os.path.join(directory, stale[0]))
+                self.cached_bytes -= stale[1]
+            self.files[key] = (name, size)
+            self.cached_bytes += size
+        with self.lock:
+            self.evict()
+
+    def key(self, path_linear):
+        return hashlib.blake2b(os.path.abspath(path_linear).encode(), digest_size=16).hexdigest()
+
+    def file_name(self, path_linear, st):
+        return "%s-%d-%d-%d.mca" % (self.key(path_linear), st.st_mtime_ns, st.st_size, self.compression_type)
+
+    def lookup(self, path_linear, st, count=True):
+        # Path and size of the cached .mca, or None if there's none for this version of the .linear
+        key, name = self.key(path_linear), self.file_name(path_linear, st)
+        with self.lock:
+            cached = self.files.get(key)
+            if cached is not None and cached[0] != name: # The .linear changed since
+                self.remove(key)
+                cached = None
+            if count:
+                self.counters["disk_hits" if cached is not None else "disk_misses"] += 1
+            if cached is None:
+                return None
+            if count:
+                self.files.move_to_end(key)
+        cache_file = os.path.join(self.directory, name)
+        if count:
+            try:
+                os.utime(cache_file)
+            except FileNotFoundError:
+                return None
+        return cache_file, cached[1]
+
+    def store_later(self, path_linear, st, region):
+        key = self.key(path_linear)
+        with self.lock:
+            if key in self.storing:
+                return
+            self.storing.add(key)
+        self.executor.submit(self.store, path_linear, st, region)
+
+    def store(self, path_linear, st, region):
+        key, name = self.key(path_linear), self.file_name(path_linear, st)
+        cache_file = os.path.join(self.directory, name)
+        try:
+            data = write_region_anvil_to_bytes(region, zlib.Z_DEFAULT_COMPRESSION, compression_type=self.compression_type)
+            with open(cache_file + ".tmp", "wb") as f:
+                f.write(data)
+            os.rename(cache_file + ".tmp", cache_file)
+            with self.lock:
+                if key in self.files:
+                    self.remove(key)
+                self.files[key] = (name, len(data))
+                self.cached_bytes += len(data)
+                self.counters["disk_stores"] += 1
+                self.evict()
+        except Exception:
+            traceback.print_exc()
+            print("Error storing region file", path_linear, "in the disk cache")
+        finally:
+            with self.lock:
+                self.storing.discard(key)
+
+    def remove(self, key):
+        # Must be called with self.lock held. Open DiskAnvilFiles keep reading the unlinked file just fine
+        name, size = self.files.pop(key)
+        self.cached_bytes -= size
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        # Must be called with self.lock held
+        while self.cached_bytes > self.cache_bytes and self.files:
+            self.remove(next(iter(self.files)))
+            self.counters["disk_evictions"] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["disk_entries"] = len(self.files)
+            stats["disk_cached_bytes"] = self.cached_bytes
+            stats["disk_cache_bytes"] = self.cache_bytes
+        return stats
+
+class WriteBack:
+    # Re-encodes committed regions as .linear in the background. A region is written once it saw no commits for `delay` seconds,
+    # or at the latest `max_delay` seconds after its first pending commit, so a busy region still reaches the disk
+    def __init__(self, delay, max_delay, compression_level):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.compression_level = compression_level
+        self.condition = threading.Condition()
+        self.pending = {} # path_linear -> (due, first commit, entry)
+        self.writing = set()
+        self.counters = {"writebacks": 0, "writeback_errors": 0, "writeback_bytes": 0}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, path_linear, entry):
+        now = time.monotonic()
+        with self.condition:
+            first = self.pending[path_linear][1] if path_linear in self.pending else now
+            self.pending[path_linear] = (min(now + self.delay, first + self.max_delay), first, entry)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                path_linear, (due, _, entry) = min(self.pending.items(), key=lambda item: item[1][0])
+                now = time.monotonic()
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+                del self.pending[path_linear]
+                self.writing.add(path_linear)
+            try:
+                self.persist(path_linear, entry)
+            finally:
+                with self.condition:
+                    self.writing.discard(path_linear)
+                    self.condition.notify_all()
+
+    def persist(self, path_linear, entry):
+        region, version = entry.snapshot()
+        try:
+            write_region_linear(path_linear, region, compression_level=self.compression_level)
+        except Exception:
+            traceback.print_exc()
+            print("Error writing back region file", path_linear)
+            with self.condition:
+                self.counters["writeback_errors"] += 1
+            self.schedule(path_linear, entry)
+            return
+        with entry.lock:
+            entry.persisted_version = max(entry.persisted_version, version)
+        with self.condition:
+            self.counters["writebacks"] += 1
+            self.counters["writeback_bytes"] += os.path.getsize(path_linear)
+        print("WRITTEN BACK", path_linear)
+
+    def flush(self, path_linear=None):
+        # Writes pending regions right away, all of them if no path is given
+        while True:
+            with self.condition:
+                while path_linear in self.writing or (path_linear is None and self.writing):
+                    self.condition.wait()
+                if path_linear is None:
+                    if not self.pending:
+                        return
+                    path, (_, _, entry) = next(iter(self.pending.items()))
+                else:
+                    if path_linear not in self.pending:
+                        return
+                    path, (_, _, entry) = path_linear, self.pending[path_linear]
+                del self.pending[path]
+                self.writing.add(path)
+            try:
+                self.persist(path, entry)
+            finally:
+                with self.condition:
+                    self.writing.discard(path)
+                    self.condition.notify_all()
+
+    def cancel(self, path_linear):
+        with self.condition:
+            while path_linear in self.writing:
+                self.condition.wait()
+            self.pending.pop(path_linear, None)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["pending_writebacks"] = len(self.pending)
+        return stats
 
 class LinearFileCache:
     FILE_DESCRIPTOR_THRESHOLD = 1000
 
-    def __init__(self, cache_size):
-        self.cache_size = cache_size
-        self.cache = OrderedDict()
+    def __init__(self, cache_bytes, write_back, disk_cache=None, compression_type=COMPRESSION_TYPE_ZLIB):
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict() # Least recently used first
+        self.cached_bytes = 0
+        self.entry_bytes = {}
         self.file_references = {}
         self.file_handle_to_path = {}
         self.next_file_handle = self.FILE_DESCRIPTOR_THRESHOLD
+        self.lock = threading.Lock()
+        self.in_flight = {} # path_linear -> Future of a generation that is running right now
+        self.mca_sizes = {} # path_linear -> (mtime_ns, size) of the .linear and the size of its .mca
+        self.counters = {"hits": 0, "misses": 0, "shared_generations": 0, "evictions": 0, "evicted_bytes": 0, "prefetches": 0, "prefetch_hits": 0, "prefetch_wasted": 0}
+        self.prefetched = set() # Prefetched entries that haven't been opened yet
+        self.write_back = write_back
+        self.disk_cache = disk_cache
+        self.compression_type = compression_type
 
     def create_file(self, path_linear):
 #        region = open(path_linear, "rb").read()
 #            content = file.read()
         start = time.time()
-        region = open_region_linear(path_linear)
-        retval = write_region_anvil_to_bytes(region, compression_level=zlib.Z_BEST_SPEED)
-        print("GENERATING ", len(retval), path_linear, (time.time() - start)*1000, "ms")
+        st = os.stat(path_linear)
+        cached = self.disk_cache.lookup(path_linear, st) if self.disk_cache else None
+        if cached is not None:
+            retval = DiskAnvilFile(cached[0], path_linear)
+        else:
+            region = open_region_linear(path_linear)
+            retval = LazyAnvilFile(region, compression_level=zlib.Z_BEST_SPEED, compression_type=self.compression_type)
+            if self.disk_cache: # A copy of the chunk list, writes from the server mustn't end up under this mtime
+                self.disk_cache.store_later(path_linear, st, Region(list(region.chunks), region.region_x, region.region_z, region.mtime, region.timestamps))
+        with self.lock:
+            self.mca_sizes[path_linear] = (st.st_mtime_ns, st.st_size, retval.size)
+        print("GENERATING ", retval.size, path_linear, (time.time() - start)*1000, "ms")
         return retval
         # Create a 10MB bytes array
 #        content = bytearray(10 * 1024 * 1024)
@@ -62,51 +543,253 @@ class LinearFileCache:
 #        return bytes(content)
 #        return linear
 
+    def add_file_handle(self, path_linear):
+        # Must be called with self.lock held
+        self.file_references[path_linear] += 1
+        file_handle = self.next_file_handle
+        self.next_file_handle += 1
+        self.file_handle_to_path[file_handle] = path_linear
+        return file_handle
+
+    def evict(self):
+        # Must be called with self.lock held. Files with open handles are pinned, the cache may go over budget until they're closed
+        for path_linear in list(self.cache):
+            if self.cached_bytes <= self.cache_bytes:
+                break
+            if self.file_references[path_linear] > 0 or not self.cache[path_linear].is_clean(): # Dirty entries stay until they're on disk
+                continue
+            self.cache.pop(path_linear).close()
+            self.file_references.pop(path_linear)
+            entry_bytes = self.entry_bytes.pop(path_linear)
+            self.cached_bytes -= entry_bytes
+            self.counters["evictions"] += 1
+            self.counters["evicted_bytes"] += entry_bytes
+            if path_linear in self.prefetched:
+                self.prefetched.discard(path_linear)
+                self.counters["prefetch_wasted"] += 1
+
+    def insert(self, path_linear, file_data):
+        # Must be called with self.lock held
+        self.cache[path_linear] = file_data
+        self.entry_bytes[path_linear] = file_data.memory_usage()
+        self.cached_bytes += self.entry_bytes[path_linear]
+        self.file_references[path_linear] = 0
+
     def open(self, path_linear):
-        if not os.path.isfile(path_linear):
+        if path_linear not in self.cache and not os.path.isfile(path_linear):
             raise FileNotFoundError(f"File {path_linear} does not exist.")
 
-        print("Found", path_linear in self.cache)
-        print("Cache contents:", self.cache.keys())
-        if path_linear not in self.cache:
-            if len(self.cache) >= self.cache_size:
-                oldest_file_path, _ = self.cache.popitem(last=False)
-                self.file_references.pop(oldest_file_path)
+        waited = False
+        while True:
+            with self.lock:
+                if path_linear in self.cache:
+                    self.cache.move_to_end(path_linear)
+                    self.counters["shared_generations" if waited else "hits"] += 1
+                    if path_linear in self.prefetched:
+                        self.prefetched.discard(path_linear)
+                        self.counters["prefetch_hits"] += 1
+                    return self.add_file_handle(path_linear)
+                future = self.in_flight.get(path_linear)
+                if future is None:
+                    future = Future()
+                    self.in_flight[path_linear] = future
+                    self.counters["misses"] += 1
+                    break
 
-            self.cache[path_linear] = self.create_file(path_linear)
-            self.file_references[path_linear] = 0
+            # Someone else is already generating this region, share their result instead of generating it twice
+            future.result()
+            waited = True
 
-        self.file_references[path_linear] += 1
-        file_handle = self.next_file_handle
-        self.next_file_handle += 1
-        self.file_handle_to_path[file_handle] = path_linear
+        try:
+            file_data = self.create_file(path_linear)
+        except BaseException as e:
+            with self.lock:
+                self.in_flight.pop(path_linear)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.insert(path_linear, file_data)
+            self.in_flight.pop(path_linear)
+            file_handle = self.add_file_handle(path_linear)
+            self.evict()
+        future.set_result(None)
 
         return file_handle
 
+    def is_cached(self, path_linear):
+        with self.lock:
+            return path_linear in self.cache or path_linear in self.in_flight
+
+    def prefetch(self, path_linear):
+        # Like open without a file handle. The entry goes in unpinned, so it's the first to go if the server never asks for it
+        with self.lock:
+            if path_linear in self.cache or path_linear in self.in_flight:
+                return
+            future = Future()
+            self.in_flight[path_linear] = future
+
+        try:
+            file_data = self.create_file(path_linear)
+        except BaseException as e:
+            with self.lock:
+                self.in_flight.pop(path_linear)
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.insert(path_linear, file_data)
+            self.in_flight.pop(path_linear)
+            self.prefetched.add(path_linear)
+            self.counters["prefetches"] += 1
+            self.evict()
+        future.set_result(None)
+
+    def mca_size(self, path_linear, st):
+        with self.lock:
+            entry = self.cache.get(path_linear)
+            if entry is not None: # Writes may have grown it past the generated layout
+                return entry.size
+            known = self.mca_sizes.get(path_linear)
+        cached = self.disk_cache.lookup(path_linear, st, count=False) if self.disk_cache else None
+        if cached is not None: # That's what an open would serve
+            return cached[1]
+        if known is not None and known[:2] == (st.st_mtime_ns, st.st_size):
+            return known[2]
+
+        try:
+            mca_size = mca_size_from_header(read_linear_header(path_linear), self.compression_type)
+            if mca_size is None: # Only a real generation can tell, and the server is about to open it anyway
+                self.close(self.open(path_linear))
+                with self.lock:
+                    known = self.mca_sizes.get(path_linear)
+                return known[2]
+        except Exception as e:
+            # Truncated or corrupt regions would fail every stat with EFAULT, they get the size of the .linear instead
+            # and the error shows up when the server actually opens them
+            print("Error reading the header of region file", path_linear, "-", e)
+            mca_size = st.st_size
+
+        with self.lock:
+            self.mca_sizes[path_linear] = (st.st_mtime_ns, st.st_size, mca_size)
+        return mca_size
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.cache)
+            stats["pinned_entries"] = sum(1 for references in self.file_references.values() if references > 0)
+            stats["cached_bytes"] = self.cached_bytes
+            stats["cache_bytes"] = self.cache_bytes
+            stats["open_file_handles"] = len(self.file_handle_to_path)
+            stats["dirty_entries"] = sum(1 for entry in self.cache.values() if not entry.is_clean())
+        stats.update(self.write_back.stats())
+        if self.disk_cache:
+            stats.update(self.disk_cache.stats())
+        lookups = stats["hits"] + stats["misses"] + stats["shared_generations"]
+        stats["hit_rate"] = (stats["hits"] + stats["shared_generations"]) / lookups if lookups else 0.0
+        stats["prefetch_hit_rate"] = stats["prefetch_hits"] / stats["prefetches"] if stats["prefetches"] else 0.0
+        return stats
+
     def close(self, file_handle):
-        if file_handle in self.file_handle_to_path:
+        self.commit(file_handle)
+        with self.lock:
+            if file_handle in self.file_handle_to_path:
+                path_linear = self.file_handle_to_path[file_handle]
+                self.file_references[path_linear] -= 1
+                self.file_handle_to_path.pop(file_handle)
+
+                if self.file_references[path_linear] == 0:
+                    self.evict()
+
+    def entry_for_handle(self, file_handle):
+        with self.lock:
+            if file_handle not in self.file_handle_to_path:
+                raise ValueError(f"Invalid file handle {file_handle}.")
             path_linear = self.file_handle_to_path[file_handle]
-            self.file_references[path_linear] -= 1
+            file_data = self.cache.get(path_linear)
 
-            if self.file_references[path_linear] == 0 and len(self.cache) >= self.cache_size:
-                self.cache.pop(path_linear)
-                self.file_references.pop(path_linear)
+        if file_data is None:
+            raise FileNotFoundError(f"File {path_linear} not found in cache.")
+        return path_linear, file_data
 
-            self.file_handle_to_path.pop(file_handle)
+    def update_entry_bytes(self, path_linear, file_data):
+        with self.lock:
+            if path_linear in self.entry_bytes:
+                memory_usage = file_data.memory_usage()
+                self.cached_bytes += memory_usage - self.entry_bytes[path_linear]
+                self.entry_bytes[path_linear] = memory_usage
 
     def read(self, file_handle, length, offset):
-        if file_handle in self.file_handle_to_path:
-            path_linear = self.file_handle_to_path[file_handle]
+        path_linear, file_data = self.entry_for_handle(file_handle)
+#        print(f"Read {length} bytes from {path_linear} at offset {offset}.")
+        retval = file_data.read(offset, length)
+        self.update_entry_bytes(path_linear, file_data) # Reads compress chunks, so the entry grows
+        return retval
+
+    def write(self, file_handle, data, offset):
+        path_linear, file_data = self.entry_for_handle(file_handle)
+        retval = file_data.write(offset, data)
+        self.update_entry_bytes(path_linear, file_data)
+        return retval
+
+    def truncate(self, path_linear, length):
+        # The handle pins the entry, generating it if needed, so it can't be evicted before the truncation is committed
+        file_handle = self.open(path_linear)
+        try:
+            _, file_data = self.entry_for_handle(file_handle)
+            file_data.truncate(length)
+            if file_data.commit(os.path.dirname(path_linear)):
+                self.write_back.schedule(path_linear, file_data)
+            self.update_entry_bytes(path_linear, file_data)
+        finally:
+            self.close(file_handle)
+
+    def commit(self, file_handle, sync=False):
+        # Parses what the server wrote since the last commit and queues the region for write-back
+        with self.lock:
+            path_linear = self.file_handle_to_path.get(file_handle)
+            file_data = self.cache.get(path_linear)
+        if file_data is None:
+            return
+        if file_data.commit(os.path.dirname(path_linear)):
+            self.update_entry_bytes(path_linear, file_data)
+            self.write_back.schedule(path_linear, file_data)
+        if sync:
+            self.write_back.flush(path_linear)
 
-            if path_linear in self.cache:
-                file_data = self.cache[path_linear]
-#                print("aaa", len(file_data))
-#                print(f"Read {length} bytes from {path_linear} at offset {offset}.")#, file_data[offset:offset + length])
-                return file_data[offset:offset + length]
-            else:
-                raise FileNotFoundError(f"File {path_linear} not found in cache.")
+    def create(self, path_linear):
+        # A new region. An empty .linear goes to disk right away so the file exists, the chunks follow with write-back
+        file_coords = os.path.basename(path_linear).split('.')[1:3]
+        region = Region([None] * (REGION_DIMENSION * REGION_DIMENSION), int(file_coords[0]), int(file_coords[1]), time.time(), [0] * (REGION_DIMENSION * REGION_DIMENSION))
+        write_region_linear(path_linear, region, compression_level=self.write_back.compression_level)
+        file_data = LazyAnvilFile(region, compression_level=zlib.Z_BEST_SPEED, compression_type=self.compression_type)
+        st = os.stat(path_linear)
+
+        with self.lock:
+            self.forget(path_linear)
+            self.mca_sizes[path_linear] = (st.st_mtime_ns, st.st_size, file_data.size)
+            self.insert(path_linear, file_data)
+            return self.add_file_handle(path_linear)
+
+    def forget(self, path_linear):
+        # Must be called with self.lock held. Drops the entry of a file that got replaced or removed under it
+        self.mca_sizes.pop(path_linear, None)
+        self.prefetched.discard(path_linear)
+        if path_linear in self.cache:
+            self.cache.pop(path_linear).close()
+            self.cached_bytes -= self.entry_bytes.pop(path_linear)
+            self.file_references.pop(path_linear)
+            for file_handle in [file_handle for file_handle, path in self.file_handle_to_path.items() if path == path_linear]:
+                self.file_handle_to_path.pop(file_handle)
+
+    def remove(self, path_linear, keep_changes):
+        if keep_changes:
+            self.write_back.flush(path_linear)
         else:
-            raise ValueError(f"Invalid file handle {file_handle}.")
+            self.write_back.cancel(path_linear)
+        with self.lock:
+            self.forget(path_linear)
 '''
 class LinearFileCache:
     def __init__(self, cache_size):
@@ -120,10 +803,116 @@ class LinearFileCache:
         pass
 '''
 
+class Prefetcher:
+    # Players move continuously, so after a region is opened its neighbours are likely next, the ones ahead of the player most of all.
+    # Warms the cache for up to `cap` regions within `radius` of every opened region, closest first and leaning towards the heading
+    HISTORY = 8
+
+    def __init__(self, linear_file_cache, threads, radius, cap):
+        self.linear_file_cache = linear_file_cache
+        self.radius = radius
+        self.cap = cap
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.history = {} # directory -> recently opened region coordinates
+        self.queued = set()
+
+    def opened(self, path_linear):
+        directory, filename = os.path.split(path_linear)
+        try:
+            region_x, region_z = (int(coordinate) for coordinate in filename.split('.')[1:3])
+        except ValueError:
+            return
+
+        with self.lock:
+            history = self.history.setdefault(directory, deque(maxlen=self.HISTORY))
+            if history and history[-1] == (region_x, region_z):
+                return
+            history.append((region_x, region_z))
+            # Where the opens have been drifting lately, a rough direction is all the ordering needs
+            heading_x, heading_z = history[-1][0] - history[0][0], history[-1][1] - history[0][1]
+
+        candidates = []
+        for dx in range(-self.radius, self.radius + 1):
+            for dz in range(-self.radius, self.radius + 1):
+                if dx or dz:
+                    candidates.append((max(abs(dx), abs(dz)), -(dx * heading_x + dz * heading_z), dx, dz))
+        candidates.sort()
+
+        submitted = 0
+        for _, _, dx, dz in candidates:
+            if submitted >= self.cap:
+                break
+            candidate = os.path.join(directory, "r.%d.%d.linear" % (region_x + dx, region_z + dz))
+            with self.lock:
+                if candidate in self.queued:
+                    continue
+            if self.linear_file_cache.is_cached(candidate) or not os.path.isfile(candidate):
+                continue
+            with self.lock:
+                self.queued.add(candidate)
+            self.executor.submit(self.prefetch, candidate)
+            submitted += 1
+
+    def prefetch(self, path_linear):
+        try:
+            self.linear_file_cache.prefetch(path_linear)
+        except Exception:
+            traceback.print_exc()
+            print("Error prefetching region file", path_linear)
+        finally:
+            with self.lock:
+                self.queued.discard(path_linear)
+
+class MetadataCache:
+    # Short lived lstat results and directory listings that are reused until the directory's mtime changes
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stats = {} # (path, follow_symlinks) -> (time of stat, stat result)
+        self.listings = {} # directory path -> (mtime_ns, entries)
+
+    def stat(self, path, follow_symlinks=False):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.stats.get((path, follow_symlinks))
+        if cached is not None and now - cached[0] < self.ttl:
+            return cached[1]
+        st = os.stat(path, follow_symlinks=follow_symlinks)
+        with self.lock:
+            self.stats[(path, follow_symlinks)] = (now, st)
+        return st
+
+    def invalidate(self, path):
+        with self.lock:
+            self.stats.pop((path, False), None)
+            self.stats.pop((path, True), None)
+            self.listings.pop(os.path.dirname(path), None)
+
+    def listdir(self, path):
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self.lock:
+            cached = self.listings.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+        entries = []
+        for f in os.listdir(path):
+            if f.endswith(".linear.tmp") or f.endswith(".linear.wip"):
+                continue
+            if f.endswith(".linear"):
+                f = f[:-7] + ".mca"
+            entries.append(f)
+        with self.lock:
+            self.listings[path] = (mtime_ns, entries)
+        return entries
+
 class LinearToMCA(Operations):
-    def __init__(self, root, linear_file_cache):
+    def __init__(self, root, linear_file_cache, metadata_cache, prefetcher=None):
         self.root = root
         self.linear_file_cache = linear_file_cache
+        self.metadata_cache = metadata_cache
+        self.prefetcher = prefetcher
 
     def _full_path(self, partial):
         if partial.startswith("/"):
@@ -152,30 +941,19 @@ class LinearToMCA(Operations):
         full_path = self._full_path(path)
         if path.endswith(".mca"):
             real_file = full_path[:-4] + ".linear"
-            st = os.lstat(real_file)
-            retval = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                     'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-            retval["st_size"] = MCA_FILES_SIZE
+            st = self.metadata_cache.stat(real_file, follow_symlinks=True) # A .linear symlinked to the HDD tier still shows up as a regular .mca
+            retval = dict((key, getattr(st, key)) for key in STAT_KEYS)
+            retval["st_size"] = self.linear_file_cache.mca_size(real_file, st)
             return retval
-        st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                     'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        st = self.metadata_cache.stat(full_path)
+        return dict((key, getattr(st, key)) for key in STAT_KEYS)
 
     def readdir(self, path, fh):
         full_path = self._full_path(path)
 
         dirents = ['.', '..']
         if os.path.isdir(full_path):
-            files = os.listdir(full_path)
-            final_files = []
-            for f in files:
-                file = f
-                if f.endswith(".linear"):
-                    file = f[:-7] + ".mca"
-                if f.endswith(".linear.tmp"):
-                    continue
-                final_files.append(file)
-            dirents.extend(final_files)
+            dirents.extend(self.metadata_cache.listdir(full_path))
         for r in dirents:
             yield r
 
@@ -209,16 +987,28 @@ class LinearToMCA(Operations):
             'f_frsize', 'f_namemax'))
 
     def unlink(self, path):
-        return
-        return os.unlink(self._full_path(path))
+        full_path = self._full_path(path)
+        if path.endswith(".mca"):
+            full_path = full_path[:-4] + ".linear"
+            self.linear_file_cache.remove(full_path, keep_changes=False)
+        self.metadata_cache.invalidate(full_path)
+        return os.unlink(full_path)
 
     def symlink(self, name, target):
         return
         return os.symlink(target, self._full_path(name))
 
     def rename(self, old, new):
-        return
-        return os.rename(self._full_path(old), self._full_path(new))
+        old_path, new_path = self._full_path(old), self._full_path(new)
+        if old.endswith(".mca") != new.endswith(".mca"): # The .linear underneath can't become anything else
+            raise FuseOSError(errno.EXDEV)
+        if old.endswith(".mca"):
+            old_path, new_path = old_path[:-4] + ".linear", new_path[:-4] + ".linear"
+            self.linear_file_cache.remove(old_path, keep_changes=True)
+            self.linear_file_cache.remove(new_path, keep_changes=False)
+        self.metadata_cache.invalidate(old_path)
+        self.metadata_cache.invalidate(new_path)
+        return os.rename(old_path, new_path)
 
     def link(self, target, name):
         return
@@ -240,6 +1030,8 @@ class LinearToMCA(Operations):
         if path.endswith(".mca"):
             real_file = full_path[:-4] + ".linear"
             file_handle = self.linear_file_cache.open(real_file)
+            if self.prefetcher:
+                self.prefetcher.opened(real_file)
 #            print("file_handle:", file_handle)
             print("open time:", time.time() - start)
             return file_handle
@@ -249,9 +1041,13 @@ class LinearToMCA(Operations):
         return retval
 
     def create(self, path, mode, fi=None):
-        return
         uid, gid, pid = fuse_get_context()
         full_path = self._full_path(path)
+        if path.endswith(".mca"):
+            real_file = full_path[:-4] + ".linear"
+            self.metadata_cache.invalidate(real_file)
+            return self.linear_file_cache.create(real_file)
+        self.metadata_cache.invalidate(full_path)
         fd = os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
         os.chown(full_path,uid,gid) #chown to context uid & gid
         return fd
@@ -269,21 +1065,22 @@ class LinearToMCA(Operations):
         return 
 
     def write(self, path, buf, offset, fh):
-        return
+        if path.endswith(".mca"):
+            return self.linear_file_cache.write(fh, buf, offset)
         os.lseek(fh, offset, os.SEEK_SET)
         return os.write(fh, buf)
 
     def truncate(self, path, length, fh=None):
         full_path = self._full_path(path)
+        if path.endswith(".mca"):
+            return self.linear_file_cache.truncate(full_path[:-4] + ".linear", length)
         with open(full_path, 'r+') as f:
             f.truncate(length)
 
     def flush(self, path, fh):
+        if path.endswith(".mca"):
+            return self.linear_file_cache.commit(fh)
         return
-        print("flush called with path: " + path + " fh: " + str(fh))
-        retval = os.fsync(fh)
-        print("RETVAL flush ", retval)
-        return retval
 
     def release(self, path, fh):
         print("release called with path: " + path + " fh: " + str(fh))
@@ -296,35 +1093,59 @@ class LinearToMCA(Operations):
         return retval
 
     def fsync(self, path, fdatasync, fh):
-        return
         print("fsync called with path: " + path + " fdatasync: " + str(fdatasync) + " fh: " + str(fh))
-        return self.flush(path, fh)
+        if path.endswith(".mca"): # The server wants it on disk, so don't wait for the write-back delay
+            return self.linear_file_cache.commit(fh, sync=True)
+        return os.fsync(fh)
 
-def main(mountpoint, root):
-    linear_file_cache = LinearFileCache(100)
-#    FUSE(LinearToMCA(root, linear_file_cache), mountpoint, nothreads=True, foreground=True, allow_other=False, ro=True)
-    FUSE(LinearToMCA(root, linear_file_cache), mountpoint, nothreads=True, foreground=True, allow_other=False, ro=False)
-
-if __name__ == '__main__':
-    main(sys.argv[2], sys.argv[1])
-'''
-import argparse
+def write_stats(linear_file_cache, stats_file, interval):
+    while True:
+        time.sleep(interval)
+        with open(stats_file + ".tmp", "w") as f:
+            json.dump(linear_file_cache.stats(), f, indent=1)
+        os.rename(stats_file + ".tmp", stats_file)
 
 def main():
-    parser = argparse.ArgumentParser(description="Fuse program for mounting a read-only file system. The program doesn't support writing files, only reading them.")
+    parser = argparse.ArgumentParser(description="Fuse program that serves .linear region files as .mca.")
 
     parser.add_argument("server_directory", type=str, help="Server directory to be mounted")
     parser.add_argument("mountpoint", type=str, help="Mount point for the server directory")
 
-    parser.add_argument("-b", "--background", action="store_true", default=False, help="Run the program in the background (default: off)")
     parser.add_argument("-a", "--allow_other", action="store_true", default=False, help="Allow other users to access the mounted directory (default: off)")
-    parser.add_argument("-c", "--cache_size", type=int, default=100, help="Cache size (default: 100)")
+    parser.add_argument("-c", "--cache-bytes", type=parse_size, default="2G", help="Memory budget for generated .mca files, accepts K/M/G/T suffixes (default: 2G)")
+    parser.add_argument("-t", "--attr-ttl", type=float, default=1, help="Seconds to reuse lstat results of the backing files (default: 1)")
+    parser.add_argument("-s", "--stats-file", type=str, help="Periodically write cache hit/miss/eviction counters as JSON to this file")
+    parser.add_argument("--stats-interval", type=float, default=10, help="Seconds between stats file updates (default: 10)")
+    parser.add_argument("-w", "--write-back-delay", type=float, default=5, help="Seconds without writes before a modified region is written back as .linear (default: 5)")
+    parser.add_argument("--write-back-max-delay", type=float, default=60, help="Longest a modified region waits for write-back while it keeps getting writes (default: 60)")
+    parser.add_argument("--chunk-compression", choices=list(CHUNK_COMPRESSION_TYPES), default="zlib", help="Compression of chunks in served .mca files, none and lz4 need a server that understands them (default: zlib)")
+    parser.add_argument("-D", "--disk-cache", type=str, help="Directory to keep generated .mca files in across evictions and restarts, e.g. on a fast SSD or tmpfs")
+    parser.add_argument("--disk-cache-bytes", type=parse_size, default="20G", help="Disk budget of the --disk-cache directory, accepts K/M/G/T suffixes (default: 20G)")
+    parser.add_argument("-p", "--prefetch-threads", type=int, default=2, help="Threads generating neighbours of opened regions ahead of time, 0 disables prefetching (default: 2)")
+    parser.add_argument("--prefetch-radius", type=int, default=1, help="How many regions around an opened region to prefetch (default: 1)")
+    parser.add_argument("--prefetch-cap", type=int, default=8, help="Most regions prefetched per opened region (default: 8)")
+    parser.add_argument("-l", "--compression-level", type=int, default=6, help="Zstd compression level of written back .linear files (default: 6)")
 
     args = parser.parse_args()
 
-    # Your Fuse program implementation here
-    # Example: mount_fuse(args.server_directory, args.mountpoint, args.background, args.allow_other, args.cache_size)
+    write_back = WriteBack(args.write_back_delay, args.write_back_max_delay, args.compression_level)
+    compression_type = CHUNK_COMPRESSION_TYPES[args.chunk_compression]
+    disk_cache = DiskCache(args.disk_cache, args.disk_cache_bytes, compression_type) if args.disk_cache else None
+    linear_file_cache = LinearFileCache(args.cache_bytes, write_back, disk_cache, compression_type)
+    metadata_cache = MetadataCache(args.attr_ttl)
+    prefetcher = None
+    if args.prefetch_threads > 0:
+        prefetcher = Prefetcher(linear_file_cache, args.prefetch_threads, args.prefetch_radius, args.prefetch_cap)
+    if args.stats_file:
+        # A thread rather than a signal handler, Python handlers don't run while the main thread sits in fuse_main
+        threading.Thread(target=write_stats, args=(linear_file_cache, args.stats_file, args.stats_interval), daemon=True).start()
+
+    try:
+#        FUSE(LinearToMCA(args.server_directory, linear_file_cache, metadata_cache), args.mountpoint, nothreads=True, foreground=True, allow_other=False, ro=True)
+        FUSE(LinearToMCA(args.server_directory, linear_file_cache, metadata_cache, prefetcher), args.mountpoint, nothreads=False, foreground=True, allow_other=args.allow_other, ro=False)
+    finally:
+        write_back.flush() # Nothing the server wrote may be lost on unmount
+        print("Cache stats:", json.dumps(linear_file_cache.stats()))
 
-if __name__ == "__main__":
+if __name__ == '__main__':
     main()
-'''
\ No newline at end of file
@@ -4,12 +4,32 @@ import pyzstd
 import zlib
 import nbtlib
 import io
+import mmap
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from array import array
 
 class Chunk:
-    def __init__(self, raw_chunk, x, z):
-        self.raw_chunk = raw_chunk
+    __slots__ = ("_raw_chunk", "view", "offset", "size", "x", "z")
+
+    def __init__(self, raw_chunk, x, z, view=None, offset=0, size=0):
+        self._raw_chunk = raw_chunk
+        self.view, self.offset, self.size = view, offset, size
         self.x, self.z = x, z
 
+    @property
+    def raw_chunk(self):
+        if self._raw_chunk is None:
+            self._raw_chunk = self.view[self.offset:self.offset + self.size]
+        return self._raw_chunk
+
+    @raw_chunk.setter
+    def raw_chunk(self, raw_chunk):
+        self._raw_chunk = raw_chunk
+        self.view = None
+
     def as_nbtlib(self):
         fileobj = io.BytesIO(self.raw_chunk)
         file = nbtlib.File.parse(fileobj)
@@ -23,39 +43,490 @@ class Chunk:
     def __str__(self):
         return "Chunk %d %d - %d bytes" % (self.x, self.z, len(self.raw_chunk))
 
+class CompactChunks:
+    # List-like view over a single decompressed region buffer, Chunk objects are only created on access
+    __slots__ = ("view", "offsets", "sizes", "region_x", "region_z", "chunks", "count")
+
+    def __init__(self, buffer, offset, sizes, region_x, region_z):
+        self.view = memoryview(buffer)
+        self.sizes = array('I', sizes)
+        self.offsets = array('I', sizes)
+        self.region_x, self.region_z = region_x, region_z
+        self.chunks = [None] * len(self.sizes)
+        self.count = 0
+
+        for i, size in enumerate(self.sizes):
+            self.offsets[i] = offset
+            offset += size
+            if size != 0: self.count += 1
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        chunk = self.chunks[i]
+        if chunk is None and self.sizes[i] != 0:
+            chunk = Chunk(None, REGION_DIMENSION * self.region_x + i % 32, REGION_DIMENSION * self.region_z + i // 32, self.view, self.offsets[i], self.sizes[i])
+            self.chunks[i] = chunk
+        return chunk
+
+    def __setitem__(self, i, chunk):
+        if i < 0: i += len(self)
+        if self.chunks[i] is not None or self.sizes[i] != 0:
+            self.count -= 1
+        self.chunks[i] = chunk
+        self.sizes[i] = 0
+        if chunk is not None:
+            self.count += 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
 class Region:
-    def __init__(self, chunks, region_x, region_z, mtime, timestamps):
+    __slots__ = ("chunks", "region_x", "region_z", "mtime", "timestamps", "version", "grid_size")
+
+    def __init__(self, chunks, region_x, region_z, mtime, timestamps, version=None, grid_size=None):
         self.chunks = chunks
         self.region_x, self.region_z = region_x, region_z
         self.mtime = mtime
         self.timestamps = timestamps
+        # Linear version and bucket grid of the file the region was read from, write_region_linear keeps them by default
+        self.version, self.grid_size = version, grid_size
 
     def chunk_count(self):
+        if isinstance(self.chunks, (CompactChunks, BucketedChunks)):
+            return self.chunks.count
         count = 0
-        for i in self.chunks:
-            count += 1
+        for chunk in self.chunks:
+            if chunk is not None: count += 1
         return count
 
+class RegionHeader:
+    def __init__(self, raw_header):
+        values = struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION * 2), raw_header, 0)
+        self.sizes = list(values[0::2])
+        self.timestamps = list(values[1::2])
+        self.bitmap = bytearray(REGION_DIMENSION * REGION_DIMENSION // 8)
+        self.chunk_count = 0
+        self.newest_timestamp = 0
+
+        for i, size in enumerate(self.sizes):
+            if size != 0:
+                self.bitmap[i // 8] |= 1 << (i % 8)
+                self.chunk_count += 1
+                self.newest_timestamp = max(self.timestamps[i], self.newest_timestamp)
+
+    def has_chunk(self, i):
+        return self.bitmap[i // 8] & (1 << (i % 8)) != 0
+
+    def total_size(self):
+        return sum(self.sizes)
+
 REGION_DIMENSION = 32
 COMPRESSION_TYPE = b'\x02'
+COMPRESSION_TYPE_GZIP = 1
 COMPRESSION_TYPE_ZLIB = 2
+COMPRESSION_TYPE_NONE = 3
+COMPRESSION_TYPE_LZ4 = 4
 EXTERNAL_FILE_COMPRESSION_TYPE = 128 + 2
+EXTERNAL_FILE_FLAG = 128
+CHUNK_COMPRESSION_TYPES = {"zlib": COMPRESSION_TYPE_ZLIB, "none": COMPRESSION_TYPE_NONE, "lz4": COMPRESSION_TYPE_LZ4}
 LINEAR_SIGNATURE = 0xc3ff13183cca9d9a
 SUPPORTED_VERSION = [1, 2]
 LINEAR_VERSION = 1
+LINEAR_VERSION_BUCKETED = 2
+HEADER_SIZE = REGION_DIMENSION * REGION_DIMENSION * 8
+SUPERBLOCK_SIZE = 32
+FOOTER_SIZE = 8
+
+# Version 2 splits the region into grid_size x grid_size buckets, each one a separate zstd frame that can be read on its own
+BUCKETED_SUPERBLOCK = ">QBQbii"
+BUCKETED_SUPERBLOCK_SIZE = 26
+BUCKET_ENTRY = ">IbQ" # Compressed size, compression level, xxhash64 of the compressed bucket
+BUCKET_ENTRY_SIZE = 13
+BUCKET_CHUNK_HEADER = ">iq" # Chunk size + 8 or 0 if there's no chunk, timestamp
+BUCKET_CHUNK_HEADER_SIZE = 12
+BITMAP_SIZE = REGION_DIMENSION * REGION_DIMENSION // 8
+BUCKET_GRID_SIZE = 8
+VALID_GRID_SIZES = [1, 2, 4, 8, 16, 32]
 
 # TODO: Alert users if the file name isn't r.0.0.linear
 
-def open_region_linear(file_path):
-    HEADER_SIZE = REGION_DIMENSION * REGION_DIMENSION * 8
+class LinearPayloadReader:
+    # Decompresses the zstd payload of a .linear file incrementally, so callers only pay for the bytes they ask for
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, f, compressed_length, zstd_dict=None):
+        self.f = f
+        self.remaining = compressed_length
+        self.decompressor = pyzstd.ZstdDecompressor(zstd_dict)
+
+    def read(self, length):
+        parts = []
+        while length > 0:
+            if self.decompressor.eof:
+                raise Exception("Decompressed size invalid")
+            data = b""
+            if self.decompressor.needs_input:
+                if self.remaining == 0:
+                    raise Exception("Decompressed size invalid")
+                data = self.f.read(min(self.BLOCK_SIZE, self.remaining))
+                if not data:
+                    raise Exception("Unexpected end of file")
+                self.remaining -= len(data)
+            part = self.decompressor.decompress(data, length)
+            parts.append(part)
+            length -= len(part)
+        return b"".join(parts)
+
+    def finish(self):
+        # Consume the end of the frame so zstd gets to verify the content checksum
+        while not self.decompressor.eof:
+            data = b""
+            if self.decompressor.needs_input:
+                if self.remaining == 0:
+                    raise Exception("Unexpected end of file")
+                data = self.f.read(min(self.BLOCK_SIZE, self.remaining))
+                if not data:
+                    raise Exception("Unexpected end of file")
+                self.remaining -= len(data)
+            if self.decompressor.decompress(data, 1):
+                raise Exception("Decompressed size invalid")
+
+def read_superblock_linear(f):
+    superblock = f.read(SUPERBLOCK_SIZE)
+    if len(superblock) != SUPERBLOCK_SIZE:
+        raise Exception("Superblock invalid")
+
+    signature, version, newest_timestamp, compression_level, chunk_count, complete_region_length, dictionary_id = struct.unpack(">QBQbhIQ", superblock)
+
+    if signature != LINEAR_SIGNATURE:
+        raise Exception("Superblock invalid")
+    if version not in SUPPORTED_VERSION:
+        raise Exception("Version invalid")
+
+    return version, newest_timestamp, compression_level, chunk_count, complete_region_length, dictionary_id
+
+def read_exactly(f, length):
+    data = f.read(length)
+    if len(data) != length:
+        raise Exception("Unexpected end of file")
+    return data
+
+def read_version_linear(f):
+    # Leaves f at the start of the file, both versions parse their superblock from there
+    signature, version = struct.unpack(">QB", read_exactly(f, 9))
+    f.seek(0)
+    if signature != LINEAR_SIGNATURE:
+        raise Exception("Superblock invalid")
+    if version not in SUPPORTED_VERSION:
+        raise Exception("Version invalid")
+    return version
+
+def xxhash_module():
+    try:
+        import xxhash
+    except ImportError:
+        raise Exception("Linear version 2 needs the xxhash package")
+    return xxhash
+
+def bucket_chunk_indices(bucket, grid_size):
+    # Chunks of a bucket in the order they're stored in it
+    bucket_size = REGION_DIMENSION // grid_size
+    bucket_x, bucket_z = divmod(bucket, grid_size)
+    return [(bucket_x * bucket_size + cx) + (bucket_z * bucket_size + cz) * REGION_DIMENSION for cx in range(bucket_size) for cz in range(bucket_size)]
+
+def chunk_bucket(i, grid_size):
+    bucket_size = REGION_DIMENSION // grid_size
+    return (i % REGION_DIMENSION // bucket_size) * grid_size + i // REGION_DIMENSION // bucket_size
+
+class BucketIndex:
+    # Everything in front of the buckets of a version 2 file
+    def __init__(self, f):
+        signature, version, self.newest_timestamp, self.grid_size, self.region_x, self.region_z = struct.unpack(BUCKETED_SUPERBLOCK, read_exactly(f, BUCKETED_SUPERBLOCK_SIZE))
+        if signature != LINEAR_SIGNATURE:
+            raise Exception("Superblock invalid")
+        if version != LINEAR_VERSION_BUCKETED:
+            raise Exception("Version invalid")
+        if self.grid_size not in VALID_GRID_SIZES:
+            raise Exception("Grid size %d invalid" % self.grid_size)
+        self.bitmap = bytearray(read_exactly(f, BITMAP_SIZE))
+
+        self.features = {}
+        while True:
+            name_length = read_exactly(f, 1)[0]
+            if name_length == 0:
+                break
+            name = read_exactly(f, name_length).decode()
+            self.features[name] = struct.unpack(">i", read_exactly(f, 4))[0]
+
+        bucket_count = self.grid_size * self.grid_size
+        entries = read_exactly(f, BUCKET_ENTRY_SIZE * bucket_count)
+        self.bucket_sizes = []
+        self.bucket_levels = []
+        self.bucket_hashes = []
+        self.bucket_offsets = []
+        offset = f.tell()
+        for bucket in range(bucket_count):
+            size, level, hash64 = struct.unpack_from(BUCKET_ENTRY, entries, BUCKET_ENTRY_SIZE * bucket)
+            self.bucket_sizes.append(size)
+            self.bucket_levels.append(level)
+            self.bucket_hashes.append(hash64)
+            self.bucket_offsets.append(offset)
+            offset += size
+        self.footer_offset = offset
+
+        self.chunk_count = 0
+        for byte in self.bitmap:
+            self.chunk_count += bin(byte).count("1")
+
+    def has_chunk(self, i):
+        return self.bitmap[i // 8] & (1 << (i % 8)) != 0
+
+def decompress_bucket(compressed, hash64):
+    if xxhash_module().xxh64_intdigest(compressed) != hash64:
+        raise Exception("Bucket hash invalid")
+    return pyzstd.decompress(compressed)
+
+def iter_bucket(bucket, grid_size, data):
+    # (chunk index, timestamp, offset, size) of every chunk slot in a decompressed bucket, size is 0 for missing chunks
+    offset = 0
+    for i in bucket_chunk_indices(bucket, grid_size):
+        size, timestamp = struct.unpack_from(BUCKET_CHUNK_HEADER, data, offset)
+        offset += BUCKET_CHUNK_HEADER_SIZE
+        if size > 0:
+            size -= 8
+            if offset + size > len(data):
+                raise Exception("Bucket size invalid")
+        yield i, timestamp, offset, max(size, 0)
+        offset += max(size, 0)
+    if offset != len(data):
+        raise Exception("Bucket size invalid")
+
+def parse_bucket(bucket, grid_size, data, region_x, region_z, chunks, timestamps):
+    # Fills chunks and timestamps with the contents of a decompressed bucket, chunks stay views into data
+    view = memoryview(data)
+    for i, timestamp, offset, size in iter_bucket(bucket, grid_size, view):
+        timestamps[i] = timestamp
+        if size > 0:
+            chunks[i] = Chunk(None, REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32, view, offset, size)
+    return view
+
+class BucketedChunks:
+    # List-like chunks of a version 2 file. A bucket is only decompressed once one of its chunks is accessed,
+    # and buckets that were never modified are written back as they are
+    def __init__(self, raw_region, index, region_x, region_z):
+        self.view = memoryview(raw_region)
+        self.index = index
+        self.region_x, self.region_z = region_x, region_z
+        self.chunks = [None] * (REGION_DIMENSION * REGION_DIMENSION)
+        self.timestamps = [0] * (REGION_DIMENSION * REGION_DIMENSION)
+        self.loaded = set()
+        self.dirty_buckets = set()
+        self.views = {} # bucket -> decompressed bucket its chunks are views into
+        self.count = index.chunk_count
+        self.lock = threading.Lock()
+
+    def compressed_bucket(self, bucket):
+        offset = self.index.bucket_offsets[bucket]
+        return self.view[offset:offset + self.index.bucket_sizes[bucket]]
+
+    def load_bucket(self, bucket, data=None):
+        if bucket in self.loaded:
+            return
+        if data is None and self.index.bucket_sizes[bucket] > 0:
+            data = decompress_bucket(self.compressed_bucket(bucket), self.index.bucket_hashes[bucket])
+        with self.lock:
+            if bucket in self.loaded:
+                return
+            if data is not None:
+                self.views[bucket] = parse_bucket(bucket, self.index.grid_size, data, self.region_x, self.region_z, self.chunks, self.timestamps)
+            for i in bucket_chunk_indices(bucket, self.index.grid_size):
+                if (self.chunks[i] is not None) != self.index.has_chunk(i):
+                    raise Exception("Chunk existence bitmap invalid")
+            self.loaded.add(bucket)
+
+    def load_all(self, threads=0):
+        buckets = [bucket for bucket in range(self.index.grid_size * self.index.grid_size) if bucket not in self.loaded and self.index.bucket_sizes[bucket] > 0]
+        # Buckets are independent frames and zstd releases the GIL, so a region can be decompressed in parallel
+        if threads > 1 and len(buckets) > 1:
+            with ThreadPoolExecutor(threads) as executor:
+                decompressed_buckets = list(executor.map(lambda bucket: decompress_bucket(self.compressed_bucket(bucket), self.index.bucket_hashes[bucket]), buckets))
+            for bucket, data in zip(buckets, decompressed_buckets):
+                self.load_bucket(bucket, data)
+        for bucket in range(self.index.grid_size * self.index.grid_size):
+            self.load_bucket(bucket)
+
+    def timestamp(self, i):
+        bucket = chunk_bucket(i, self.index.grid_size)
+        if bucket not in self.loaded and not self.index.has_chunk(i):
+            return 0
+        self.load_bucket(bucket)
+        return self.timestamps[i]
+
+    def set_timestamp(self, i, timestamp):
+        bucket = chunk_bucket(i, self.index.grid_size)
+        self.load_bucket(bucket)
+        self.timestamps[i] = timestamp
+        self.dirty_buckets.add(bucket)
+
+    def copy(self):
+        # Shares the file contents and the loaded chunks, later modifications of either copy don't show up in the other
+        copy = BucketedChunks.__new__(BucketedChunks)
+        copy.view, copy.index, copy.region_x, copy.region_z = self.view, self.index, self.region_x, self.region_z
+        with self.lock:
+            copy.chunks, copy.timestamps = list(self.chunks), list(self.timestamps)
+            copy.loaded, copy.dirty_buckets, copy.views = set(self.loaded), set(self.dirty_buckets), dict(self.views)
+            copy.count = self.count
+        copy.lock = threading.Lock()
+        return copy
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        bucket = chunk_bucket(i, self.index.grid_size)
+        if bucket not in self.loaded:
+            if not self.index.has_chunk(i): # The bitmap answers that without decompressing anything
+                return None
+            self.load_bucket(bucket)
+        return self.chunks[i]
+
+    def __setitem__(self, i, chunk):
+        if i < 0: i += len(self)
+        bucket = chunk_bucket(i, self.index.grid_size)
+        self.load_bucket(bucket)
+        if self.chunks[i] is not None:
+            self.count -= 1
+        self.chunks[i] = chunk
+        if chunk is not None:
+            self.count += 1
+        self.dirty_buckets.add(bucket)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class BucketedTimestamps:
+    # Region.timestamps of a BucketedChunks region, timestamps live in the buckets too
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0: i += len(self)
+        return self.chunks.timestamp(i)
+
+    def __setitem__(self, i, timestamp):
+        if i < 0: i += len(self)
+        self.chunks.set_timestamp(i, timestamp)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def read_bucketed_header(f):
+    # Version 2 keeps chunk sizes and timestamps inside the buckets, so every bucket has to be decompressed, chunks aren't built though
+    index = BucketIndex(f)
+    values = [0] * (REGION_DIMENSION * REGION_DIMENSION * 2)
+    for bucket in range(index.grid_size * index.grid_size):
+        if index.bucket_sizes[bucket] > 0:
+            data = decompress_bucket(read_exactly(f, index.bucket_sizes[bucket]), index.bucket_hashes[bucket])
+            for i, timestamp, offset, size in iter_bucket(bucket, index.grid_size, data):
+                values[2 * i], values[2 * i + 1] = size, timestamp
+    return RegionHeader(struct.pack(">%dI" % len(values), *values)), index.chunk_count
+
+def load_dictionary(file_path):
+    return pyzstd.ZstdDict(open(file_path, 'rb').read())
+
+def check_dictionary(dictionary_id, zstd_dict):
+    # The reserved superblock field holds the ID of the zstd dictionary the region was compressed with, 0 means none
+    if dictionary_id == 0:
+        return None
+    if zstd_dict is None:
+        raise Exception("Region requires zstd dictionary %d" % dictionary_id)
+    if zstd_dict.dict_id != dictionary_id:
+        raise Exception("Region requires zstd dictionary %d, got %d" % (dictionary_id, zstd_dict.dict_id))
+    return zstd_dict
+
+def open_fd_noatime(file_path):
+    # Bookkeeping reads shouldn't look like the server reading the region, tiering_daemon.py ranks regions by atime
+    try:
+        return os.open(file_path, os.O_RDONLY | getattr(os, "O_NOATIME", 0))
+    except PermissionError: # O_NOATIME is only allowed for the owner of the file
+        return os.open(file_path, os.O_RDONLY)
+
+def open_noatime(file_path):
+    return os.fdopen(open_fd_noatime(file_path), 'rb')
+
+def read_linear_header(file_path, zstd_dict=None):
+    with open_noatime(file_path) as f:
+        if read_version_linear(f) == LINEAR_VERSION_BUCKETED:
+            header, chunk_count = read_bucketed_header(f)
+            if header.chunk_count != chunk_count:
+                raise Exception("Chunk count invalid")
+            return header
+
+        version, newest_timestamp, compression_level, chunk_count, complete_region_length, dictionary_id = read_superblock_linear(f)
+        zstd_dict = check_dictionary(dictionary_id, zstd_dict)
+        header = RegionHeader(LinearPayloadReader(f, complete_region_length, zstd_dict).read(HEADER_SIZE))
+
+    if header.chunk_count != chunk_count:
+        raise Exception("Chunk count invalid")
+
+    return header
 
+def iter_chunks_linear(file_path, zstd_dict=None):
+    # Yields (chunk, timestamp) pairs, write_region_linear_streaming and write_region_anvil_streaming take the same
+    file_coords = file_path.split('/')[-1].split('.')[1:3]
+    region_x, region_z = int(file_coords[0]), int(file_coords[1])
+
+    with open(file_path, 'rb') as f:
+        if read_version_linear(f) == LINEAR_VERSION_BUCKETED:
+            # One bucket in memory at a time, chunks come out in bucket order
+            index = BucketIndex(f)
+            for bucket in range(index.grid_size * index.grid_size):
+                if index.bucket_sizes[bucket] > 0:
+                    data = decompress_bucket(read_exactly(f, index.bucket_sizes[bucket]), index.bucket_hashes[bucket])
+                    for i, timestamp, offset, size in iter_bucket(bucket, index.grid_size, data):
+                        if size > 0:
+                            yield Chunk(data[offset:offset + size], REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32), timestamp
+            return
+
+        version, newest_timestamp, compression_level, chunk_count, complete_region_length, dictionary_id = read_superblock_linear(f)
+        payload = LinearPayloadReader(f, complete_region_length, check_dictionary(dictionary_id, zstd_dict))
+        header = RegionHeader(payload.read(HEADER_SIZE))
+
+        if header.chunk_count != chunk_count:
+            raise Exception("Chunk count invalid")
+
+        for i in range(REGION_DIMENSION * REGION_DIMENSION):
+            if header.sizes[i] > 0:
+                yield Chunk(payload.read(header.sizes[i]), REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32), header.timestamps[i]
+        payload.finish()
+
+def open_region_linear(file_path, compact=True, zstd_dict=None, threads=0):
     file_coords = file_path.split('/')[-1].split('.')[1:3]
     region_x, region_z = int(file_coords[0]), int(file_coords[1])
 
     raw_region = open(file_path, 'rb').read()
     mtime = os.path.getmtime(file_path)
 
-    signature, version, newest_timestamp, compression_level, chunk_count, complete_region_length, reserved = struct.unpack_from(">QBQbhIQ", raw_region, 0)
+    if len(raw_region) > 8 and raw_region[8] == LINEAR_VERSION_BUCKETED:
+        return open_region_linear_bucketed(raw_region, region_x, region_z, mtime, compact, threads)
+
+    signature, version, newest_timestamp, compression_level, chunk_count, complete_region_length, dictionary_id = struct.unpack_from(">QBQbhIQ", raw_region, 0)
 
     if signature != LINEAR_SIGNATURE:
         raise Exception("Superblock invalid")
@@ -67,26 +538,21 @@ def open_region_linear(file_path):
     if signature != LINEAR_SIGNATURE:
         raise Exception("Footer signature invalid")
 
-    decompressed_region = pyzstd.decompress(raw_region[32:-8])
+    decompressed_region = pyzstd.decompress(memoryview(raw_region)[SUPERBLOCK_SIZE:-FOOTER_SIZE], check_dictionary(dictionary_id, zstd_dict))
 
-    sizes = []
-    timestamps = []
+    header = RegionHeader(decompressed_region)
+    sizes = header.sizes
 
-    real_chunk_count = 0
-    total_size = 0
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        size, timestamp = struct.unpack_from(">II", decompressed_region, i * 8)
-        total_size += size
-        if size != 0: real_chunk_count += 1
-        sizes.append(size)
-        timestamps.append(timestamp)
-
-    if total_size + HEADER_SIZE != len(decompressed_region):
+    if header.total_size() + HEADER_SIZE != len(decompressed_region):
         raise Exception("Decompressed size invalid")
 
-    if real_chunk_count != chunk_count:
+    if header.chunk_count != chunk_count:
         raise Exception("Chunk count invalid")
 
+    if compact:
+        chunks = CompactChunks(decompressed_region, HEADER_SIZE, sizes, region_x, region_z)
+        return Region(chunks, region_x, region_z, mtime, array('I', header.timestamps), LINEAR_VERSION)
+
     chunks = [None] * REGION_DIMENSION * REGION_DIMENSION
 
     iterator = HEADER_SIZE
@@ -95,202 +561,627 @@ def open_region_linear(file_path):
             chunks[i] = Chunk(decompressed_region[iterator: iterator + sizes[i]], REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32)
         iterator += sizes[i]
 
-    return Region(chunks, region_x, region_z, mtime, timestamps)
+    return Region(chunks, region_x, region_z, mtime, header.timestamps, LINEAR_VERSION)
 
-def quickly_verify_linear(file_path):
-    try:
-        raw_region = open(file_path, 'rb').read()
-    except FileNotFoundError: return False
-    mtime = os.path.getmtime(file_path)
+def open_region_linear_bucketed(raw_region, region_x, region_z, mtime, compact=True, threads=0):
+    index = BucketIndex(io.BytesIO(raw_region))
 
-    signature, version, newest_timestamp, compression_level, chunk_count, complete_region_length, hash64 = struct.unpack_from(">QBQbhIQ", raw_region, 0)
+    if struct.unpack_from(">Q", raw_region, index.footer_offset)[0] != LINEAR_SIGNATURE or index.footer_offset + FOOTER_SIZE != len(raw_region):
+        raise Exception("Footer signature invalid")
 
-    if signature != LINEAR_SIGNATURE:
-        return False
-    if version not in SUPPORTED_VERSION:
-        return False
+    chunks = BucketedChunks(raw_region, index, region_x, region_z)
+    if compact: # Buckets get decompressed as they're used, unless threads ask for all of them up front
+        if threads > 1:
+            chunks.load_all(threads)
+        return Region(chunks, region_x, region_z, mtime, BucketedTimestamps(chunks), LINEAR_VERSION_BUCKETED, index.grid_size)
 
-    signature = struct.unpack(">Q", raw_region[-8:])[0]
+    chunks.load_all(threads)
+    return Region(chunks.chunks, region_x, region_z, mtime, chunks.timestamps, LINEAR_VERSION_BUCKETED, index.grid_size)
 
-    if signature != LINEAR_SIGNATURE:
+def read_chunk_linear(file_path, x, z, zstd_dict=None):
+    # A single chunk, or None if the region doesn't have it. Version 2 files only read and decompress the chunk's bucket,
+    # version 1 files have to be decompressed up to the chunk
+    file_coords = file_path.split('/')[-1].split('.')[1:3]
+    region_x, region_z = int(file_coords[0]), int(file_coords[1])
+    i = x % REGION_DIMENSION + (z % REGION_DIMENSION) * REGION_DIMENSION
+
+    with open(file_path, 'rb') as f:
+        if read_version_linear(f) == LINEAR_VERSION_BUCKETED:
+            index = BucketIndex(f)
+            if not index.has_chunk(i):
+                return None
+            bucket = chunk_bucket(i, index.grid_size)
+            compressed = os.pread(f.fileno(), index.bucket_sizes[bucket], index.bucket_offsets[bucket])
+            if len(compressed) != index.bucket_sizes[bucket]:
+                raise Exception("Unexpected end of file")
+            chunks = [None] * (REGION_DIMENSION * REGION_DIMENSION)
+            parse_bucket(bucket, index.grid_size, decompress_bucket(compressed, index.bucket_hashes[bucket]), region_x, region_z, chunks, [0] * (REGION_DIMENSION * REGION_DIMENSION))
+            return chunks[i]
+
+        version, newest_timestamp, compression_level, chunk_count, complete_region_length, dictionary_id = read_superblock_linear(f)
+        payload = LinearPayloadReader(f, complete_region_length, check_dictionary(dictionary_id, zstd_dict))
+        header = RegionHeader(payload.read(HEADER_SIZE))
+        if header.sizes[i] == 0:
+            return None
+        skip = sum(header.sizes[:i])
+        while skip > 0:
+            skip -= len(payload.read(min(skip, LinearPayloadReader.BLOCK_SIZE)))
+        return Chunk(payload.read(header.sizes[i]), REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32)
+
+VERIFY_BLOCK_SIZE = 1024 * 1024
+
+def verify_payload_linear(fd, compressed_length, chunk_count, zstd_dict):
+    # Streams the version 1 payload through zstd, which checks the content checksum at the end of the frame,
+    # and compares the header with the amount of data behind it. Only the header is kept in memory
+    decompressor = pyzstd.ZstdDecompressor(zstd_dict)
+    header = bytearray()
+    decompressed_length = 0
+    offset = SUPERBLOCK_SIZE
+    end = SUPERBLOCK_SIZE + compressed_length
+    while offset < end:
+        if decompressor.eof:
+            raise Exception("Data after zstd frame")
+        data = os.pread(fd, min(VERIFY_BLOCK_SIZE, end - offset), offset)
+        if not data:
+            raise Exception("Unexpected end of file")
+        offset += len(data)
+        part = decompressor.decompress(data)
+        decompressed_length += len(part)
+        if len(header) < HEADER_SIZE:
+            header += part[:HEADER_SIZE - len(header)]
+    if not decompressor.eof:
+        raise Exception("Zstd frame incomplete")
+    if decompressor.unused_data:
+        raise Exception("Data after zstd frame")
+    if len(header) != HEADER_SIZE:
+        raise Exception("Header invalid")
+
+    header = RegionHeader(header)
+    if header.chunk_count != chunk_count:
+        raise Exception("Chunk count invalid")
+    if HEADER_SIZE + sum(header.sizes) != decompressed_length:
+        raise Exception("Decompressed size invalid")
+
+def verify_buckets_linear(fd, size):
+    # Checks every bucket hash and zstd checksum of a version 2 file and that the chunks inside match the bitmap
+    with os.fdopen(fd, 'rb', closefd=False) as f:
+        index = BucketIndex(f)
+    if index.footer_offset + FOOTER_SIZE != size:
+        raise Exception("Bucket sizes invalid")
+    for bucket in range(index.grid_size * index.grid_size):
+        if index.bucket_sizes[bucket] > 0:
+            compressed = os.pread(fd, index.bucket_sizes[bucket], index.bucket_offsets[bucket])
+            if len(compressed) != index.bucket_sizes[bucket]:
+                raise Exception("Unexpected end of file")
+            present = set(i for i, _, _, chunk_size in iter_bucket(bucket, index.grid_size, decompress_bucket(compressed, index.bucket_hashes[bucket])) if chunk_size > 0)
+        else:
+            present = set()
+        for i in bucket_chunk_indices(bucket, index.grid_size):
+            if (i in present) != index.has_chunk(i):
+                raise Exception("Chunk existence bitmap invalid")
+
+def verify_linear(file_path, size=None, deep=False, zstd_dict=None):
+    # Raises an Exception describing the problem. Without deep only the superblock and the footer are read,
+    # deep decompresses everything but never builds chunks
+    fd = open_fd_noatime(file_path)
+    try:
+        if size is None:
+            size = os.fstat(fd).st_size
+        if size < SUPERBLOCK_SIZE + FOOTER_SIZE:
+            raise Exception("File too small")
+        superblock = os.pread(fd, SUPERBLOCK_SIZE, 0)
+        footer = os.pread(fd, FOOTER_SIZE, size - FOOTER_SIZE)
+        if len(superblock) != SUPERBLOCK_SIZE or len(footer) != FOOTER_SIZE:
+            raise Exception("Unexpected end of file")
+
+        signature, version = struct.unpack_from(">QB", superblock, 0)
+        if signature != LINEAR_SIGNATURE:
+            raise Exception("Superblock invalid")
+        if version not in SUPPORTED_VERSION:
+            raise Exception("Version invalid")
+        if struct.unpack(">Q", footer)[0] != LINEAR_SIGNATURE:
+            raise Exception("Footer signature invalid")
+
+        if version == LINEAR_VERSION_BUCKETED:
+            grid_size = struct.unpack_from(BUCKETED_SUPERBLOCK, superblock, 0)[3]
+            if grid_size not in VALID_GRID_SIZES:
+                raise Exception("Grid size %d invalid" % grid_size)
+            if deep:
+                verify_buckets_linear(fd, size)
+        else:
+            _, _, _, _, chunk_count, complete_region_length, dictionary_id = struct.unpack(">QBQbhIQ", superblock)
+            if SUPERBLOCK_SIZE + complete_region_length + FOOTER_SIZE != size:
+                raise Exception("Payload length invalid")
+            if deep:
+                verify_payload_linear(fd, complete_region_length, chunk_count, check_dictionary(dictionary_id, zstd_dict))
+    finally:
+        os.close(fd)
+
+def quickly_verify_linear(file_path, size=None, deep=False, zstd_dict=None):
+    try:
+        verify_linear(file_path, size, deep, zstd_dict)
+        return True
+    except Exception:
         return False
 
-    return True
+def verify_many(paths, threads=0, deep=False, zstd_dict=None):
+    # (path, error or None) for every file, in order. Paths can be os.DirEntry objects from os.scandir,
+    # their size then comes from the stat data the directory scan already has
+    def verify(path):
+        size = None
+        if isinstance(path, os.DirEntry):
+            size = path.stat().st_size
+            path = path.path
+        try:
+            verify_linear(path, size, deep, zstd_dict)
+            return path, None
+        except Exception as e:
+            return path, str(e) or type(e).__name__
+
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(verify, paths))
+    return [verify(path) for path in paths]
+
+def linear_compression_option(compression_level, workers=0, job_size=0):
+    option = {pyzstd.CParameter.compressionLevel : compression_level,
+                pyzstd.CParameter.checksumFlag : 1}
+    if workers > 0: # Multi-threaded zstd still produces a single frame, readers don't notice the difference
+        option[pyzstd.CParameter.nbWorkers] = workers
+        if job_size > 0:
+            option[pyzstd.CParameter.jobSize] = job_size
+    return option
+
+def write_region_linear(destination_filename, region: Region, compression_level=1, workers=0, job_size=0, zstd_dict=None, version=None, grid_size=None):
+    # Without a version, a region read from a version 2 file stays version 2 with the same grid
+    if version is None:
+        version = region.version or LINEAR_VERSION
+    if version == LINEAR_VERSION_BUCKETED:
+        if zstd_dict is not None:
+            raise Exception("Dictionaries are only supported by Linear version 1")
+        if grid_size is None:
+            grid_size = region.grid_size or BUCKET_GRID_SIZE
+        return write_region_linear_bucketed(destination_filename, region, compression_level, grid_size, workers)
 
-def write_region_linear(destination_filename, region: Region, compression_level=1):
     inside_header = []
     newest_timestamp = 0
     chunk_count = 0
+    total_size = HEADER_SIZE
 
     for i in range(32**2):
         if region.chunks[i] != None:
-            inside_header.append(struct.pack(">II", len(region.chunks[i].raw_chunk), region.timestamps[i]))
+            size = len(region.chunks[i].raw_chunk)
+            inside_header.append(struct.pack(">II", size, region.timestamps[i]))
             newest_timestamp = max(region.timestamps[i], newest_timestamp)
             chunk_count += 1
+            total_size += size
         else:
             inside_header.append(b"\x00" * 8)
 
-    chunks = []
+    # Header and chunks go straight into the compressor, the region is never joined into one buffer
+    def pieces():
+        yield b''.join(inside_header)
+        for i in range(32**2):
+            if region.chunks[i] != None:
+                yield region.chunks[i].raw_chunk
 
-    for i in range(32**2):
+    write_linear_payload(destination_filename, pieces(), total_size, newest_timestamp, chunk_count, region.mtime, compression_level, workers, job_size, zstd_dict)
+
+def build_bucket(region, bucket, grid_size):
+    pieces = []
+    for i in bucket_chunk_indices(bucket, grid_size):
         if region.chunks[i] != None:
-            chunks.append(region.chunks[i].raw_chunk)
+            raw_chunk = region.chunks[i].raw_chunk
+            pieces.append(struct.pack(BUCKET_CHUNK_HEADER, len(raw_chunk) + 8, region.timestamps[i]))
+            pieces.append(raw_chunk)
         else:
-            chunks.append(b"")
-
-    complete_region = b''.join(inside_header) + b''.join(chunks)
-    complete_region_hash = b"\x00" * 8
+            pieces.append(struct.pack(BUCKET_CHUNK_HEADER, 0, 0))
+    return b''.join(pieces)
+
+def reusable_bucket(region, bucket, grid_size):
+    # The compressed bucket of the file the region was read from, if nothing in it changed since
+    chunks = region.chunks
+    if not isinstance(chunks, BucketedChunks) or chunks.index.grid_size != grid_size:
+        return None
+    if bucket in chunks.dirty_buckets or chunks.index.bucket_sizes[bucket] == 0:
+        return None
+    # Chunks edited in place (raw_chunk, from_nbtlib) drop their view, only untouched views into the bucket count
+    if bucket in chunks.loaded:
+        for i in bucket_chunk_indices(bucket, grid_size):
+            chunk = chunks.chunks[i]
+            if chunk is not None and chunk.view is not chunks.views.get(bucket):
+                return None
+    if not (isinstance(region.timestamps, BucketedTimestamps) and region.timestamps.chunks is chunks):
+        for i in bucket_chunk_indices(bucket, grid_size):
+            if chunks[i] is not None and region.timestamps[i] != chunks.timestamp(i):
+                return None
+    return bytes(chunks.compressed_bucket(bucket)), chunks.index.bucket_levels[bucket], chunks.index.bucket_hashes[bucket]
+
+def write_region_linear_bucketed(destination_filename, region: Region, compression_level=1, grid_size=BUCKET_GRID_SIZE, threads=0):
+    if grid_size not in VALID_GRID_SIZES:
+        raise Exception("Grid size %d invalid" % grid_size)
+    xxhash = xxhash_module()
+    option = linear_compression_option(compression_level)
+    features = region.chunks.index.features if isinstance(region.chunks, BucketedChunks) else {}
+
+    bitmap = bytearray(BITMAP_SIZE)
+    newest_timestamp = 0
+    for i in range(REGION_DIMENSION * REGION_DIMENSION):
+        if region.chunks[i] != None:
+            bitmap[i // 8] |= 1 << (i % 8)
+            newest_timestamp = max(region.timestamps[i], newest_timestamp)
 
-    option = {pyzstd.CParameter.compressionLevel : compression_level,
-                pyzstd.CParameter.checksumFlag : 1}
-    complete_region = pyzstd.compress(complete_region, level_or_option=option)
+    def compress_bucket(bucket):
+        reused = reusable_bucket(region, bucket, grid_size)
+        if reused is not None:
+            return reused
+        if all(region.chunks[i] == None for i in bucket_chunk_indices(bucket, grid_size)):
+            return b"", 0, 0
+        compressed = pyzstd.compress(build_bucket(region, bucket, grid_size), level_or_option=option)
+        return compressed, compression_level, xxhash.xxh64_intdigest(compressed)
+
+    # Buckets are independent frames and zstd releases the GIL, so they can be compressed in parallel
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            buckets = list(executor.map(compress_bucket, range(grid_size * grid_size)))
+    else:
+        buckets = [compress_bucket(bucket) for bucket in range(grid_size * grid_size)]
 
-    preheader = struct.pack(">QBQbhI", LINEAR_SIGNATURE, LINEAR_VERSION, newest_timestamp, compression_level, chunk_count, len(complete_region))
-    footer = struct.pack(">Q", LINEAR_SIGNATURE)
+    with open(destination_filename + ".wip", "wb") as f:
+        f.write(struct.pack(BUCKETED_SUPERBLOCK, LINEAR_SIGNATURE, LINEAR_VERSION_BUCKETED, newest_timestamp, grid_size, region.region_x, region.region_z))
+        f.write(bitmap)
+        for name, value in features.items():
+            name = name.encode()
+            f.write(struct.pack(">B", len(name)) + name + struct.pack(">i", value))
+        f.write(b"\x00")
+        for compressed, level, hash64 in buckets:
+            f.write(struct.pack(BUCKET_ENTRY, len(compressed), level, hash64))
+        for compressed, _, _ in buckets:
+            f.write(compressed)
+        f.write(struct.pack(">Q", LINEAR_SIGNATURE))
+        f.flush()
+        os.fsync(f.fileno()) # Ensure atomicity on Btrfs
+    os.utime(destination_filename + ".wip", (region.mtime, region.mtime))
+    os.rename(destination_filename + ".wip", destination_filename)
 
-    final_region_file = preheader + complete_region_hash + complete_region + footer
+def set_pledged_size(compressor, size):
+    # Stores the content size in the frame header like pyzstd.compress does, the method name differs between pyzstd versions
+    pledge = getattr(compressor, "set_pledged_input_size", None) or getattr(compressor, "_set_pledged_input_size", None)
+    if pledge is not None:
+        pledge(size)
+
+def write_linear_payload(destination_filename, pieces, total_size, newest_timestamp, chunk_count, mtime, compression_level, workers=0, job_size=0, zstd_dict=None):
+    option = linear_compression_option(compression_level, workers, job_size)
+    compressor = pyzstd.ZstdCompressor(level_or_option=option, zstd_dict=zstd_dict)
+    set_pledged_size(compressor, total_size)
+    complete_region_length = 0
+    dictionary_id = 0
+    if zstd_dict is not None:
+        if zstd_dict.dict_id == 0:
+            raise Exception("Dictionary has no ID")
+        dictionary_id = zstd_dict.dict_id
 
     with open(destination_filename + ".wip", "wb") as f:
-        f.write(final_region_file)
+        f.write(b"\x00" * SUPERBLOCK_SIZE) # Filled in once the compressed length is known
+        for piece in pieces:
+            compressed = compressor.compress(piece)
+            f.write(compressed)
+            complete_region_length += len(compressed)
+        compressed = compressor.flush()
+        f.write(compressed)
+        complete_region_length += len(compressed)
+        f.write(struct.pack(">Q", LINEAR_SIGNATURE))
+
+        f.seek(0)
+        f.write(struct.pack(">QBQbhIQ", LINEAR_SIGNATURE, LINEAR_VERSION, newest_timestamp, compression_level, chunk_count, complete_region_length, dictionary_id))
         f.flush()
         os.fsync(f.fileno()) # Ensure atomicity on Btrfs
-    os.utime(destination_filename + ".wip", (region.mtime, region.mtime))
+    os.utime(destination_filename + ".wip", (mtime, mtime))
     os.rename(destination_filename + ".wip", destination_filename)
 
-def open_region_anvil(file_path):
+def write_region_linear_streaming(destination_filename, chunks, mtime, compression_level=1, workers=0, job_size=0, zstd_dict=None):
+    # The header has to precede the chunks in the stream, so chunk payloads are spooled to disk until all sizes are known
+    sizes = [0] * (REGION_DIMENSION * REGION_DIMENSION)
+    timestamps = [0] * (REGION_DIMENSION * REGION_DIMENSION)
+    spool_offsets = [0] * (REGION_DIMENSION * REGION_DIMENSION)
+
+    with tempfile.TemporaryFile() as spool:
+        for chunk, timestamp in chunks:
+            i = chunk.x % REGION_DIMENSION + (chunk.z % REGION_DIMENSION) * REGION_DIMENSION
+            timestamps[i] = timestamp
+            spool_offsets[i] = spool.tell()
+            spool.write(chunk.raw_chunk)
+            sizes[i] = spool.tell() - spool_offsets[i]
+
+        inside_header = []
+        newest_timestamp = 0
+        chunk_count = 0
+        for i in range(REGION_DIMENSION * REGION_DIMENSION):
+            if sizes[i] > 0:
+                inside_header.append(struct.pack(">II", sizes[i], timestamps[i]))
+                newest_timestamp = max(timestamps[i], newest_timestamp)
+                chunk_count += 1
+            else:
+                inside_header.append(b"\x00" * 8)
+
+        def pieces():
+            yield b''.join(inside_header)
+            for i in range(REGION_DIMENSION * REGION_DIMENSION):
+                if sizes[i] > 0:
+                    spool.seek(spool_offsets[i])
+                    yield spool.read(sizes[i])
+
+        write_linear_payload(destination_filename, pieces(), HEADER_SIZE + sum(sizes), newest_timestamp, chunk_count, mtime, compression_level, workers, job_size, zstd_dict)
+
+# Type 4 chunks are lz4-java LZ4BlockOutputStream streams, which is what the server writes them with
+LZ4_BLOCK_MAGIC = b"LZ4Block"
+LZ4_BLOCK_HEADER = "<8sBiii"
+LZ4_BLOCK_HEADER_SIZE = 21
+LZ4_BLOCK_SIZE = 64 * 1024
+LZ4_BLOCK_LEVEL = 6 # log2(LZ4_BLOCK_SIZE) - 10
+LZ4_METHOD_RAW = 0x10
+LZ4_METHOD_LZ4 = 0x20
+LZ4_CHECKSUM_SEED = 0x9747b28c
+
+def lz4_modules():
+    try:
+        import lz4.block
+        import xxhash
+    except ImportError:
+        raise Exception("LZ4 chunk compression needs the lz4 and xxhash packages")
+    return lz4.block, xxhash
+
+def lz4_block_compress(data):
+    lz4_block, xxhash = lz4_modules()
+    data = memoryview(data)
+    out = []
+    for start in range(0, len(data), LZ4_BLOCK_SIZE):
+        block = data[start:start + LZ4_BLOCK_SIZE]
+        checksum = xxhash.xxh32_intdigest(block, seed=LZ4_CHECKSUM_SEED) & 0xFFFFFFF
+        compressed = lz4_block.compress(block, store_size=False)
+        if len(compressed) < len(block):
+            out.append(struct.pack(LZ4_BLOCK_HEADER, LZ4_BLOCK_MAGIC, LZ4_METHOD_LZ4 | LZ4_BLOCK_LEVEL, len(compressed), len(block), checksum))
+            out.append(compressed)
+        else: # Incompressible blocks are stored as they are, like lz4-java does
+            out.append(struct.pack(LZ4_BLOCK_HEADER, LZ4_BLOCK_MAGIC, LZ4_METHOD_RAW | LZ4_BLOCK_LEVEL, len(block), len(block), checksum))
+            out.append(block)
+    out.append(struct.pack(LZ4_BLOCK_HEADER, LZ4_BLOCK_MAGIC, LZ4_METHOD_RAW | LZ4_BLOCK_LEVEL, 0, 0, 0))
+    return b"".join(out)
+
+def lz4_block_decompress(data):
+    lz4_block, xxhash = lz4_modules()
+    data = memoryview(data)
+    out = []
+    offset = 0
+    while True:
+        magic, token, compressed_length, original_length, checksum = struct.unpack_from(LZ4_BLOCK_HEADER, data, offset)
+        if magic != LZ4_BLOCK_MAGIC:
+            raise Exception("Invalid LZ4 block magic")
+        offset += LZ4_BLOCK_HEADER_SIZE
+        if original_length == 0:
+            break
+        block = data[offset:offset + compressed_length]
+        if token & 0xF0 == LZ4_METHOD_LZ4:
+            block = lz4_block.decompress(block, uncompressed_size=original_length)
+        elif token & 0xF0 != LZ4_METHOD_RAW:
+            raise Exception("Invalid LZ4 block method %d" % (token & 0xF0))
+        if xxhash.xxh32_intdigest(block, seed=LZ4_CHECKSUM_SEED) & 0xFFFFFFF != checksum:
+            raise Exception("LZ4 block checksum mismatch")
+        out.append(block)
+        offset += compressed_length
+    return b"".join(out)
+
+def lz4_block_bound(size):
+    # Incompressible blocks are stored raw, so every block costs at most its header
+    return size + LZ4_BLOCK_HEADER_SIZE * ((size + LZ4_BLOCK_SIZE - 1) // LZ4_BLOCK_SIZE + 1)
+
+def compress_chunk(raw_chunk, compression_type, compression_level):
+    if compression_type == COMPRESSION_TYPE_ZLIB:
+        return zlib.compress(raw_chunk, compression_level)
+    if compression_type == COMPRESSION_TYPE_NONE:
+        return bytes(raw_chunk)
+    if compression_type == COMPRESSION_TYPE_LZ4:
+        return lz4_block_compress(raw_chunk)
+    raise Exception("Compression type %d unimplemented!" % (compression_type))
+
+def decompress_chunk(compressed, compression_type):
+    if compression_type == COMPRESSION_TYPE_ZLIB:
+        return zlib.decompress(compressed)
+    if compression_type == COMPRESSION_TYPE_GZIP:
+        return zlib.decompress(compressed, 16 + zlib.MAX_WBITS)
+    if compression_type == COMPRESSION_TYPE_NONE:
+        return bytes(compressed)
+    if compression_type == COMPRESSION_TYPE_LZ4:
+        return lz4_block_decompress(compressed)
+    raise Exception("Compression type %d unimplemented!" % (compression_type))
+
+def decompress_chunks_anvil(view, source_folder, region_x, region_z, threads=0):
+    SECTOR = 4096
+
+    indices = []
+    compression_types = []
+    compressed_chunks = []
+    locations = struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), view, 0)
+
+    for i in range(REGION_DIMENSION * REGION_DIMENSION):
+        chunk_start, sector_count = locations[i] >> 8, locations[i] & 0xff
+        if chunk_start > 0 and sector_count > 0:
+            chunk_end = SECTOR * (chunk_start + sector_count)
+            chunk_size, compression_type = struct.unpack_from(">IB", view, SECTOR * chunk_start)
+            if compression_type & EXTERNAL_FILE_FLAG:
+                compressed_chunks.append(open(source_folder + "/c.%d.%d.mcc" % (REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32), "rb").read())
+            else:
+                compressed_chunks.append(view[SECTOR * chunk_start + 5:min(SECTOR * chunk_start + 4 + chunk_size, chunk_end)])
+            compression_types.append(compression_type & ~EXTERNAL_FILE_FLAG)
+            indices.append(i)
+
+    # zlib and lz4 release the GIL, so chunks of a single region can be decompressed in parallel
+    if threads > 1 and len(compressed_chunks) > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            decompressed_chunks = list(executor.map(decompress_chunk, compressed_chunks, compression_types))
+    else:
+        decompressed_chunks = [decompress_chunk(compressed, compression_type) for compressed, compression_type in zip(compressed_chunks, compression_types)]
+    compressed_chunks.clear() # Slices have to be gone before the mapping can be closed
+    return indices, decompressed_chunks
+
+def open_region_anvil(file_path, threads=0):
     SECTOR = 4096
 
-    chunk_starts = []
-    chunk_sizes = []
     timestamps = []
-    chunks = []
+    chunks = [None] * (REGION_DIMENSION * REGION_DIMENSION)
 
     file_coords = file_path.split('/')[-1].split('.')[1:3]
     region_x, region_z = int(file_coords[0]), int(file_coords[1])
 
     mtime = os.path.getmtime(file_path)
-    anvil_file = open(file_path, 'rb').read()
+    with open(file_path, 'rb') as f:
+        anvil_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
     source_folder = file_path.rpartition("/")[0]
+    view = memoryview(anvil_file)
 
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        a, b, c, sector_count = struct.unpack_from(">BBBB", anvil_file, i * 4)
-        chunk_starts.append(c + b * 256 + a * 256 * 256)
-        chunk_sizes.append(sector_count)
-
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        timestamps.append(struct.unpack_from(">I", anvil_file, SECTOR + i * 4)[0])
-
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        if chunk_starts[i] > 0 and chunk_sizes[i] > 0:
-            whole_raw_chunk = anvil_file[SECTOR * chunk_starts[i]:SECTOR * (chunk_starts[i] + chunk_sizes[i])]
-            chunk_size, compression_type = struct.unpack_from(">IB", whole_raw_chunk, 0)
-            if compression_type == COMPRESSION_TYPE_ZLIB:
-                chunks.append(Chunk(zlib.decompress(whole_raw_chunk[5:5 + chunk_size]), REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32))
-            elif compression_type == EXTERNAL_FILE_COMPRESSION_TYPE:
-                external_file = open(source_folder + "/c.%d.%d.mcc" % (REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32), "rb").read()
-                chunks.append(Chunk(zlib.decompress(external_file), REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32))
-            else:
-                raise Exception("Compression type %d unimplemented!" % (compression_type))
-        else:
-            chunks.append(None)
+    try:
+        timestamps = list(struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), view, SECTOR))
+        indices, decompressed_chunks = decompress_chunks_anvil(view, source_folder, region_x, region_z, threads)
+    except Exception as e:
+        # Frames in the traceback still hold slices of the mapping, it couldn't be closed and the error would get replaced
+        traceback.clear_frames(e.__traceback__)
+        raise
+    finally:
+        view.release()
+        anvil_file.close()
+
+    for i, decompressed in zip(indices, decompressed_chunks):
+        chunks[i] = Chunk(decompressed, REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32)
 
     return Region(chunks, region_x, region_z, mtime, timestamps)
 
+def iter_chunks_anvil(file_path):
+    # Like open_region_anvil with one chunk in memory at a time, yields (chunk, timestamp) pairs
+    SECTOR = 4096
+
+    file_coords = file_path.split('/')[-1].split('.')[1:3]
+    region_x, region_z = int(file_coords[0]), int(file_coords[1])
+    source_folder = file_path.rpartition("/")[0]
 
-def write_region_anvil(destination_filename, region: Region, compression_level=zlib.Z_DEFAULT_COMPRESSION):
+    with open(file_path, 'rb') as f:
+        header = read_exactly(f, 2 * SECTOR)
+        locations = struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), header, 0)
+        timestamps = struct.unpack_from(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), header, SECTOR)
+
+        for i in range(REGION_DIMENSION * REGION_DIMENSION):
+            chunk_start, sector_count = locations[i] >> 8, locations[i] & 0xff
+            if chunk_start > 0 and sector_count > 0:
+                x, z = REGION_DIMENSION * region_x + i % 32, REGION_DIMENSION * region_z + i // 32
+                f.seek(SECTOR * chunk_start)
+                data = f.read(SECTOR * sector_count)
+                chunk_size, compression_type = struct.unpack_from(">IB", data, 0)
+                if compression_type & EXTERNAL_FILE_FLAG:
+                    compressed = open(source_folder + "/c.%d.%d.mcc" % (x, z), "rb").read()
+                else:
+                    compressed = memoryview(data)[5:4 + chunk_size]
+                yield Chunk(decompress_chunk(compressed, compression_type & ~EXTERNAL_FILE_FLAG), x, z), timestamps[i]
+
+
+def compress_chunks_anvil(region: Region, compression_level, threads=0, compression_type=COMPRESSION_TYPE_ZLIB):
+    indices = [i for i in range(REGION_DIMENSION * REGION_DIMENSION) if region.chunks[i] != None]
+    raw_chunks = [region.chunks[i].raw_chunk for i in indices]
+
+    # zlib and lz4 release the GIL, so chunks can be compressed in parallel
+    if threads > 1 and len(raw_chunks) > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            compressed_chunks = list(executor.map(lambda raw_chunk: compress_chunk(raw_chunk, compression_type, compression_level), raw_chunks))
+    else:
+        compressed_chunks = [compress_chunk(raw_chunk, compression_type, compression_level) for raw_chunk in raw_chunks]
+
+    return indices, compressed_chunks
+
+def write_external_chunk(destination_folder, x, z, compressed, mtime):
+    print("Chunk in external file", x, z)
+    chunk_file_path = destination_folder + "/c.%d.%d.mcc" % (x, z)
+    open(chunk_file_path + ".wip", "wb").write(compressed)
+    os.utime(chunk_file_path + ".wip", (mtime, mtime))
+    os.rename(chunk_file_path + ".wip", chunk_file_path)
+
+def build_region_anvil(region: Region, compression_level, threads=0, destination_folder=None, compression_type=COMPRESSION_TYPE_ZLIB):
     SECTOR = 4096
 
-    destination_folder = destination_filename.rpartition("/")[0]
-    header_chunks = []
-    header_timestamps = []
-    sectors = []
+    indices, compressed_chunks = compress_chunks_anvil(region, compression_level, threads, compression_type)
     start_sectors = []
+    sector_counts = []
     free_sector = 2
 
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
+    for i, compressed in zip(indices, compressed_chunks):
+        sector_count = (len(compressed) + 5 + SECTOR - 1) // SECTOR
+        if sector_count > 255:
+            x, z = i % 32, i // 32
+            if destination_folder is None:
+                raise Exception("Chunk %d %d doesn't fit in a region file" % (region.region_x * 32 + x, region.region_z * 32 + z))
+            write_external_chunk(destination_folder, region.region_x * 32 + x, region.region_z * 32 + z, compressed, region.mtime)
+            sector_count = 1
         start_sectors.append(free_sector)
-        if region.chunks[i] != None:
-            compressed = zlib.compress(region.chunks[i].raw_chunk, compression_level)
-            final_chunk_data = struct.pack(">I", len(compressed) + 1) + COMPRESSION_TYPE + compressed
-
-            padding = 4096 - (len(final_chunk_data) % 4096)
-            if padding == 4096:
-                padding = 0
-            final_chunk_data += b'\x00' * padding
-
-            sector_count = len(final_chunk_data) // 4096
-            if sector_count > 255:
-                x, z = i % 32, i // 32
-                print("Chunk in external file", region.region_x * 32 + x, region.region_z * 32 + z)
-                chunk_file_path = destination_folder + "/c.%d.%d.mcc" % (region.region_x * 32 + x, region.region_z * 32 + z)
-                open(chunk_file_path + ".wip", "wb").write(compressed)
-                os.utime(chunk_file_path + ".wip", (region.mtime, region.mtime))
-                os.rename(chunk_file_path + ".wip", chunk_file_path)
-
-                final_chunk_data = struct.pack(">IB", 1, EXTERNAL_FILE_COMPRESSION_TYPE)
-                sector_count = 1
-                padding = 4096 - (len(final_chunk_data) % 4096)
-                if padding == 4096:
-                    padding = 0
-                final_chunk_data += b'\x00' * padding
-            sectors.append(final_chunk_data)
-            free_sector += sector_count
+        sector_counts.append(sector_count)
+        free_sector += sector_count
+
+    # Sectors are laid out once and the chunks are copied straight into place, padding is already zeroed
+    region_file = bytearray(SECTOR * free_sector)
+    struct.pack_into(">%dI" % (REGION_DIMENSION * REGION_DIMENSION), region_file, SECTOR, *region.timestamps)
+
+    for i, compressed, start_sector, sector_count in zip(indices, compressed_chunks, start_sectors, sector_counts):
+        struct.pack_into(">I", region_file, i * 4, (start_sector << 8) | sector_count)
+        offset = SECTOR * start_sector
+        if len(compressed) + 5 > SECTOR * sector_count:
+            struct.pack_into(">IB", region_file, offset, 1, EXTERNAL_FILE_FLAG | compression_type)
         else:
-            sectors.append(b'')
+            struct.pack_into(">IB", region_file, offset, len(compressed) + 1, compression_type)
+            region_file[offset + 5:offset + 5 + len(compressed)] = compressed
 
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        if region.chunks[i] != None:
-            sector_count = len(sectors[i]) // 4096
-            header_chunks.append(struct.pack(">IB", start_sectors[i], sector_count)[1:])
-        else:
-            header_chunks.append(b"\x00\x00\x00\x00")
+    return region_file
 
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        header_timestamps.append(struct.pack(">I", region.timestamps[i]))
+def write_region_anvil(destination_filename, region: Region, compression_level=zlib.Z_DEFAULT_COMPRESSION, threads=0, compression_type=COMPRESSION_TYPE_ZLIB):
+    destination_folder = destination_filename.rpartition("/")[0]
+    region_file = build_region_anvil(region, compression_level, threads, destination_folder, compression_type)
 
     with open(destination_filename + ".wip", "wb") as f:
-        f.write(b''.join(header_chunks) + b''.join(header_timestamps) + b''.join(sectors))
+        f.write(region_file)
         f.flush()
         os.fsync(f.fileno()) # Ensure atomicity on Btrfs
     os.utime(destination_filename + ".wip", (region.mtime, region.mtime))
     os.rename(destination_filename + ".wip", destination_filename)
 
-
-def write_region_anvil_to_bytes(region: Region, compression_level=zlib.Z_DEFAULT_COMPRESSION): # CAREFUL: Doesn't support MCC!
+def write_region_anvil_streaming(destination_filename, chunks, mtime, compression_level=zlib.Z_DEFAULT_COMPRESSION, compression_type=COMPRESSION_TYPE_ZLIB):
+    # Takes (chunk, timestamp) pairs. Every chunk is compressed and written as it comes, the header is filled in at the end
     SECTOR = 4096
-
-    header_chunks = []
-    header_timestamps = []
-    sectors = []
-    start_sectors = []
+    destination_folder = destination_filename.rpartition("/")[0]
+    header = bytearray(2 * SECTOR)
     free_sector = 2
 
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        start_sectors.append(free_sector)
-        if region.chunks[i] != None:
-            compressed = zlib.compress(region.chunks[i].raw_chunk, compression_level)
-            final_chunk_data = struct.pack(">I", len(compressed) + 1) + COMPRESSION_TYPE + compressed
-
-            padding = 4096 - (len(final_chunk_data) % 4096)
-            if padding == 4096:
-                padding = 0
-            final_chunk_data += b'\x00' * padding
-
-            sector_count = len(final_chunk_data) // 4096
-            sectors.append(final_chunk_data)
+    with open(destination_filename + ".wip", "wb") as f:
+        f.write(header)
+        for chunk, timestamp in chunks:
+            i = chunk.x % REGION_DIMENSION + (chunk.z % REGION_DIMENSION) * REGION_DIMENSION
+            compressed = compress_chunk(chunk.raw_chunk, compression_type, compression_level)
+            sector_count = (len(compressed) + 5 + SECTOR - 1) // SECTOR
+            if sector_count > 255:
+                write_external_chunk(destination_folder, chunk.x, chunk.z, compressed, mtime)
+                f.write(struct.pack(">IB", 1, EXTERNAL_FILE_FLAG | compression_type))
+                f.write(bytes(SECTOR - 5))
+                sector_count = 1
+            else:
+                f.write(struct.pack(">IB", len(compressed) + 1, compression_type))
+                f.write(compressed)
+                f.write(bytes(SECTOR * sector_count - 5 - len(compressed)))
+            struct.pack_into(">I", header, i * 4, (free_sector << 8) | sector_count)
+            struct.pack_into(">I", header, SECTOR + i * 4, timestamp)
             free_sector += sector_count
-        else:
-            sectors.append(b'')
 
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        if region.chunks[i] != None:
-            sector_count = len(sectors[i]) // 4096
-            header_chunks.append(struct.pack(">IB", start_sectors[i], sector_count)[1:])
-        else:
-            header_chunks.append(b"\x00\x00\x00\x00")
-
-    for i in range(REGION_DIMENSION * REGION_DIMENSION):
-        header_timestamps.append(struct.pack(">I", region.timestamps[i]))
+        f.seek(0)
+        f.write(header)
+        f.flush()
+        os.fsync(f.fileno()) # Ensure atomicity on Btrfs
+    os.utime(destination_filename + ".wip", (mtime, mtime))
+    os.rename(destination_filename + ".wip", destination_filename)
 
-    return b''.join(header_chunks) + b''.join(header_timestamps) + b''.join(sectors)
+def write_region_anvil_to_bytes(region: Region, compression_level=zlib.Z_DEFAULT_COMPRESSION, threads=0, compression_type=COMPRESSION_TYPE_ZLIB): # CAREFUL: Doesn't support MCC!
+    # A bytearray, copying the whole region into bytes would undo the preallocated build
+    return build_region_anvil(region, compression_level, threads, compression_type=compression_type)
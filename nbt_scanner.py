@@ -0,0 +1,130 @@
+import struct
+
+# Reads a few fields out of raw NBT without building a tree. Everything that wasn't asked for is skipped by its length,
+# so the cost is one pass over the tag headers instead of an object per tag like nbtlib
+
+TAG_END, TAG_BYTE, TAG_SHORT, TAG_INT, TAG_LONG, TAG_FLOAT, TAG_DOUBLE, TAG_BYTE_ARRAY, TAG_STRING, TAG_LIST, TAG_COMPOUND, TAG_INT_ARRAY, TAG_LONG_ARRAY = range(13)
+
+FORMATS = {TAG_BYTE: ">b", TAG_SHORT: ">h", TAG_INT: ">i", TAG_LONG: ">q", TAG_FLOAT: ">f", TAG_DOUBLE: ">d"}
+ARRAY_ITEM_SIZES = {TAG_BYTE_ARRAY: 1, TAG_INT_ARRAY: 4, TAG_LONG_ARRAY: 8}
+# Payload size of every tag type byte, 0 for the ones that have to be parsed to be skipped
+FIXED_SIZES = tuple({TAG_BYTE: 1, TAG_SHORT: 2, TAG_INT: 4, TAG_LONG: 8, TAG_FLOAT: 4, TAG_DOUBLE: 8}.get(tag_type, 0) for tag_type in range(256))
+
+CHUNK_FIELDS = ("xPos", "zPos", "Status", "InhabitedTime", "LastUpdate")
+
+unpack_short = struct.Struct(">H").unpack_from
+unpack_int = struct.Struct(">i").unpack_from
+unpack_list = struct.Struct(">Bi").unpack_from
+
+def skip_payload(view, offset, tag_type):
+    # This is where almost all of the time goes, so fixed size tags are skipped inline instead of recursing
+    size = FIXED_SIZES[tag_type]
+    if size:
+        return offset + size
+    if tag_type == TAG_COMPOUND:
+        while True:
+            item_type = view[offset]
+            if item_type == TAG_END:
+                return offset + 1
+            offset += 3 + unpack_short(view, offset + 1)[0]
+            size = FIXED_SIZES[item_type]
+            offset = offset + size if size else skip_payload(view, offset, item_type)
+    if tag_type == TAG_STRING:
+        return offset + 2 + unpack_short(view, offset)[0]
+    if tag_type in ARRAY_ITEM_SIZES:
+        return offset + 4 + ARRAY_ITEM_SIZES[tag_type] * max(unpack_int(view, offset)[0], 0)
+    if tag_type == TAG_LIST:
+        item_type, length = unpack_list(view, offset)
+        offset += 5
+        if length <= 0:
+            return offset
+        size = FIXED_SIZES[item_type]
+        if size: # Lists of numbers are skipped in one step, only lists of compounds, strings etc. need a walk
+            return offset + size * length
+        for _ in range(length):
+            offset = skip_payload(view, offset, item_type)
+        return offset
+    raise Exception("NBT tag type %d invalid" % tag_type)
+
+def read_value(view, offset, tag_type, end):
+    # Numbers and strings become Python values, everything else stays a memoryview of its payload
+    if end > len(view):
+        raise Exception("NBT truncated")
+    fmt = FORMATS.get(tag_type)
+    if fmt is not None:
+        return struct.unpack_from(fmt, view, offset)[0]
+    if tag_type == TAG_STRING:
+        return str(view[offset + 2:end], "utf-8", "surrogatepass")
+    return view[offset:end]
+
+class NbtScanner:
+    # Paths are compound keys separated by dots, like "xPos" or "structures.References". Compile once, scan many chunks
+    def __init__(self, paths=CHUNK_FIELDS):
+        self.paths = list(dict.fromkeys(paths))
+        self.tree = {}
+        for path in self.paths:
+            node = self.tree
+            keys = path.split(".")
+            for depth, key in enumerate(keys):
+                key = key.encode()
+                candidates = node.setdefault(len(key), [])
+                entry = next((entry for entry in candidates if entry[0] == key), None)
+                if entry is None:
+                    entry = [key, None, None]
+                    candidates.append(entry)
+                if depth == len(keys) - 1:
+                    entry[1] = path
+                else:
+                    if entry[2] is None:
+                        entry[2] = {}
+                    node = entry[2]
+
+    def scan(self, data):
+        # Returns path -> value for the paths that exist, stops reading as soon as all of them were found
+        view = memoryview(data)
+        if len(view) < 3 or view[0] != TAG_COMPOUND:
+            raise Exception("NBT root is not a compound")
+        result = {}
+        try:
+            self.scan_compound(view, 3 + unpack_short(view, 1)[0], self.tree, result)
+        except (IndexError, struct.error):
+            raise Exception("NBT truncated")
+        return result
+
+    def scan_compound(self, view, offset, node, result):
+        # Returns the offset after the compound, or -1 once every path was found
+        while True:
+            tag_type = view[offset]
+            offset += 1
+            if tag_type == TAG_END:
+                return offset
+            name_length = unpack_short(view, offset)[0]
+            offset += 2
+            match = None
+            candidates = node.get(name_length) # Names are only compared when the length fits one of the keys
+            if candidates:
+                name = view[offset:offset + name_length]
+                for entry in candidates:
+                    if name == entry[0]:
+                        match = entry
+                        break
+            offset += name_length
+            if match is None:
+                offset = skip_payload(view, offset, tag_type)
+                continue
+
+            _, path, children = match
+            if children is not None and tag_type == TAG_COMPOUND:
+                end = self.scan_compound(view, offset, children, result)
+                if end < 0:
+                    return end
+            else:
+                end = skip_payload(view, offset, tag_type)
+            if path is not None:
+                result[path] = read_value(view, offset, tag_type, end)
+                if len(result) == len(self.paths):
+                    return -1
+            offset = end
+
+def scan_chunk(chunk, paths=CHUNK_FIELDS):
+    return NbtScanner(paths).scan(chunk.raw_chunk)
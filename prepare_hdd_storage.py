@@ -1,73 +1,73 @@
 #!/usr/bin/env python3
 import argparse
 import os
-import shutil
 import sys
 from datetime import datetime
-from tqdm import tqdm
+from tiering import Throttle, add_tiering_arguments, copy_file, clean_temporaries, run_tasks
 
 class CustomArgumentParser(argparse.ArgumentParser):
     def error(self, _):
         self.print_help()
         sys.exit(1)
 
-def main(source_dir, dest_dir, cutoff_date):
-    print(f"Preparing a file list from {source_dir}, this can take a minute.")
-    files = os.listdir(source_dir)
-    files_to_copy = [f for f in files if f.endswith(".linear")]
-
-    copied_files = 0
-    skipped_files = 0
-    already_exists_files = 0
-    symlink_files = 0
-
-    try:
-        for file in tqdm(files_to_copy, desc="Copying files"):
-            src_path = os.path.join(source_dir, file)
-            dest_path = os.path.join(dest_dir, file)
-            dest_tmp_path = dest_path + ".tmp"
-
-            if os.path.islink(src_path):
-                symlink_files += 1
+def plan_copies(source_dir, dest_dir, cutoff_date):
+    # Files already copied by an earlier, possibly interrupted, run have the same mtime and size and are skipped
+    counters = {"skipped": 0, "already_exists": 0, "symlink": 0}
+    tasks = []
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".linear"):
                 continue
-
-            if not os.path.isfile(src_path):
-                skipped_files += 1
+            if entry.is_symlink():
+                counters["symlink"] += 1
+                continue
+            if not entry.is_file():
+                counters["skipped"] += 1
                 continue
 
-            file_mtime = os.path.getmtime(src_path)
-            file_datetime = datetime.fromtimestamp(file_mtime)
+            st = entry.stat()
+            if datetime.fromtimestamp(st.st_mtime) >= cutoff_date:
+                counters["skipped"] += 1
+                continue
+            try:
+                dest_stat = os.stat(os.path.join(dest_dir, entry.name))
+                if st.st_mtime <= dest_stat.st_mtime and st.st_size == dest_stat.st_size:
+                    counters["already_exists"] += 1
+                    continue
+            except FileNotFoundError:
+                pass
+            tasks.append((entry.name, st.st_size))
+    tasks.sort(key=lambda task: task[1], reverse=True)
+    return tasks, counters
 
-            if file_datetime < cutoff_date:
-                if not os.path.exists(dest_path):
-                    shutil.copy2(src_path, dest_tmp_path)
-                    os.rename(dest_tmp_path, dest_path)
-                    copied_files += 1
-                else:
-                    dest_mtime = os.path.getmtime(dest_path)
-                    dest_size = os.path.getsize(dest_path)
+def main(source_dir, dest_dir, cutoff_date, args):
+    removed = clean_temporaries(dest_dir)
+    if removed:
+        print(f"Removed {removed} partial copies of an interrupted run")
+    print(f"Preparing a file list from {source_dir}, this can take a minute.")
+    tasks, counters = plan_copies(source_dir, dest_dir, cutoff_date)
+    print(f"{len(tasks)} region files to copy, %.1f MB" % (sum(size for _, size in tasks) / 2**20))
 
-                    if file_mtime > dest_mtime or os.path.getsize(src_path) != dest_size:
-                        shutil.copy2(src_path, dest_tmp_path)
-                        os.rename(dest_tmp_path, dest_path)
-                        copied_files += 1
-                    else:
-                        already_exists_files += 1
-            else:
-                skipped_files += 1
-    except KeyboardInterrupt:
-        pass
+    throttle = Throttle(args.max_mbps, args.max_iops)
+    def copy_region(task):
+        copy_file(os.path.join(source_dir, task[0]), os.path.join(dest_dir, task[0]), throttle)
+        return "copied"
+    results = run_tasks(tasks, copy_region, args.workers, desc="Copying files")
 
-    print(f"Copied region files: {copied_files}")
-    print(f"Skipped region files: {skipped_files}")
-    print(f"Already existing region files: {already_exists_files}")
-    print(f"Symlink files ignored: {symlink_files}")
+    print(f"Copied region files: {results['copied']}")
+    print(f"Failed region files: {results['error']}")
+    print(f"Skipped region files: {counters['skipped']}")
+    print(f"Already existing region files: {counters['already_exists']}")
+    print(f"Symlink files ignored: {counters['symlink']}")
+    if results["interrupted"]:
+        print("Interrupted, run again to copy the rest")
 
 if __name__ == "__main__":
     parser = CustomArgumentParser(description="Copy files with certain conditions")
     parser.add_argument("cutoff", type=str, help="Cutoff date in the format YYYY-MM-DD")
     parser.add_argument("source", type=str, help="Source directory")
     parser.add_argument("destination", type=str, help="Destination directory")
+    add_tiering_arguments(parser)
 
     args = parser.parse_args()
 
@@ -75,4 +75,4 @@ if __name__ == "__main__":
     dest_dir = args.destination
     cutoff_date = datetime.strptime(args.cutoff, "%Y-%m-%d")
 
-    main(source_dir, dest_dir, cutoff_date)
+    main(source_dir, dest_dir, cutoff_date, args)
@@ -0,0 +1,197 @@
+import os
+import errno
+import fcntl
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from tqdm import tqdm
+from linear import open_noatime
+
+FICLONE = 0x40049409 # ioctl that shares the blocks of one file with another on btrfs, XFS and similar
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+class TokenBucket:
+    # Allows rate units per second on average with bursts of up to one second. A take bigger than that waits for a full bucket
+    # and leaves it in debt, so big files still average out to the rate
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                needed = min(amount, self.rate)
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                delay = (needed - self.tokens) / self.rate
+            time.sleep(delay)
+
+class Throttle:
+    # Bandwidth and operations shared by all workers, 0 means unlimited
+    def __init__(self, max_mbps=0, max_iops=0):
+        self.bandwidth = TokenBucket(max_mbps * 2**20)
+        self.operations = TokenBucket(max_iops)
+
+    def take(self, size, operations=1):
+        self.operations.take(operations)
+        self.bandwidth.take(size)
+
+def parse_size(value):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1:].upper()])
+    return int(value)
+
+def add_tiering_arguments(parser):
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Files moved at the same time (default: 4)")
+    parser.add_argument("-m", "--max-mbps", type=float, default=0, help="Limit to this many MB/s (default: unlimited)")
+    parser.add_argument("-i", "--max-iops", type=float, default=0, help="Limit to this many file operations per second (default: unlimited)")
+
+def reflink(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+def copy_range(src_fd, dst_fd, size, throttle):
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    offset = 0
+    while offset < size:
+        length = min(COPY_BLOCK_SIZE, size - offset)
+        throttle.take(length)
+        if use_copy_file_range:
+            try:
+                copied = os.copy_file_range(src_fd, dst_fd, length, offset, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                use_copy_file_range = False # Older kernels can't do it across filesystems
+        if not use_copy_file_range:
+            copied = os.pwrite(dst_fd, os.pread(src_fd, length, offset), offset)
+        if copied == 0:
+            raise Exception("Source file shrank while copying")
+        offset += copied
+
+def copy_to_temporary(src_path, dst_path, throttle):
+    # Copies to dst_path.tmp, so an interrupted copy never leaves a half file under the real name. The copy gets the
+    # mtime of the inode that was actually copied, the tiering scripts compare mtimes before they replace anything
+    tmp_path = dst_path + ".tmp"
+    with open_noatime(src_path) as src, open(tmp_path, "wb") as dst:
+        st = os.fstat(src.fileno())
+        if reflink(src.fileno(), dst.fileno()):
+            throttle.take(0)
+        else:
+            copy_range(src.fileno(), dst.fileno(), st.st_size, throttle)
+        os.fsync(dst.fileno())
+    os.chmod(tmp_path, st.st_mode & 0o7777)
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return tmp_path, st
+
+def copy_file(src_path, dst_path, throttle):
+    tmp_path, st = copy_to_temporary(src_path, dst_path, throttle)
+    os.rename(tmp_path, dst_path)
+    return st.st_size
+
+def is_same_file(a, b):
+    return a.st_mtime == b.st_mtime and a.st_size == b.st_size
+
+def swap_to_symlink(server_path, storage_path, throttle):
+    # Replaces a server file with a symlink to its storage copy, only if both still have the same mtime and size.
+    # The symlink is created next to the file and renamed over it, so the server never sees the region missing
+    try:
+        server_stat = os.stat(server_path, follow_symlinks=False)
+        storage_stat = os.stat(storage_path)
+    except FileNotFoundError:
+        return False
+    if os.path.islink(server_path) or not is_same_file(server_stat, storage_stat):
+        return False
+    throttle.take(server_stat.st_size)
+    tmp_path = server_path + ".tmp"
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    os.symlink(os.path.abspath(storage_path), tmp_path)
+    if not is_same_file(os.stat(tmp_path), storage_stat) or not is_same_file(os.stat(server_path, follow_symlinks=False), server_stat):
+        os.unlink(tmp_path)
+        return False
+    os.rename(tmp_path, server_path)
+    return True
+
+def swap_to_file(server_path, throttle):
+    # The other direction, replaces a symlink on the server with a copy of its target. The server replaces the symlink
+    # itself when it saves the region, so the copy is only renamed over it if the symlink and its target are unchanged
+    try:
+        link_stat = os.stat(server_path, follow_symlinks=False)
+        storage_path = os.path.realpath(server_path)
+        storage_stat = os.stat(storage_path)
+    except FileNotFoundError:
+        return False
+    if not os.path.islink(server_path):
+        return False
+    tmp_path, copied_stat = copy_to_temporary(storage_path, server_path, throttle)
+    try:
+        unchanged = os.stat(server_path, follow_symlinks=False).st_ino == link_stat.st_ino and is_same_file(os.stat(storage_path), storage_stat) and is_same_file(copied_stat, storage_stat)
+    except FileNotFoundError:
+        unchanged = False
+    if not unchanged:
+        os.unlink(tmp_path)
+        return False
+    os.rename(tmp_path, server_path)
+    return True
+
+def clean_temporaries(directory):
+    # Leftovers of an interrupted run, everything else it did is already complete and gets skipped
+    removed = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(".linear.tmp"):
+                os.unlink(entry.path)
+                removed += 1
+    return removed
+
+def run_tasks(tasks, worker, workers=4, desc="Moving files", verbose=False):
+    # tasks are (name, size, ...) tuples, worker returns a status name for each. Progress is weighted by bytes.
+    # Ctrl+C stops handing out tasks and lets the running ones finish, so the next run can resume from there
+    counters = Counter()
+    progress_bar = tqdm(total=sum(task[1] for task in tasks), desc=desc, unit="B", unit_scale=True, unit_divisor=1024, disable=verbose)
+
+    def collect(done):
+        for future in done:
+            task = futures.pop(future)
+            try:
+                status = future.result()
+            except Exception as e:
+                status = "error"
+                tqdm.write(f"Error with {task[0]}: {e}")
+            counters[status] += 1
+            if verbose:
+                print(f"{sum(counters.values())}/{len(tasks)} - {status} {task[0]}")
+            progress_bar.update(task[1])
+
+    futures = {}
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            for task in tasks:
+                if len(futures) >= 2 * workers:
+                    collect(wait(futures, return_when=FIRST_COMPLETED).done)
+                futures[executor.submit(worker, task)] = task
+            while futures:
+                collect(wait(futures, return_when=FIRST_COMPLETED).done)
+        except KeyboardInterrupt:
+            print("Interrupted, waiting for the running files to finish")
+            for future in list(futures):
+                if future.cancel():
+                    del futures[future]
+            collect(wait(futures).done)
+            counters["interrupted"] += 1
+    progress_bar.close()
+    return counters
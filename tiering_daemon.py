@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+from linear import read_linear_header
+from tiering import Throttle, add_tiering_arguments, parse_size, copy_file, is_same_file, swap_to_symlink, swap_to_file, clean_temporaries, run_tasks
+
+# Regions already on the SSD rank a bit higher, so regions near the cutoff don't bounce between the tiers every pass
+STICKINESS = 1.1
+
+class CustomArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        sys.stderr.write(f"error: {message}\n")
+        self.print_help()
+        sys.exit(1)
+
+class HeatTracker:
+    # Heat of a region is how recently it was written (mtime), read (atime) and how many of its chunks the server saved
+    # recently (chunk timestamps in the Linear header), each decaying by half every half_life seconds.
+    # The header is only read again when the file changed
+    def __init__(self, half_life):
+        self.half_life = half_life
+        self.headers = {} # path -> mtime_ns, size, atime_ns after our read, atime_ns before it, chunk activity, time it was computed
+
+    def decay(self, age):
+        return 0.5 ** (max(age, 0) / self.half_life)
+
+    def read_header(self, path, st):
+        try:
+            header = read_linear_header(path)
+            now = time.time()
+            timestamps = [header.timestamps[i] for i in range(len(header.sizes)) if header.sizes[i] > 0]
+            activity = sum(self.decay(now - timestamp) for timestamp in timestamps) / len(timestamps) if timestamps else 0
+        except Exception as e:
+            print("Error with region file", path, "-", e)
+            now, activity = time.time(), 0
+        try:
+            atime_after = os.stat(path).st_atime_ns
+        except FileNotFoundError:
+            atime_after = st.st_atime_ns
+        entry = (st.st_mtime_ns, st.st_size, atime_after, st.st_atime_ns, activity, now)
+        self.headers[path] = entry
+        return entry
+
+    def heat(self, path, st, now):
+        entry = self.headers.get(path)
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+            entry = self.read_header(path, st)
+        _, _, atime_after, atime_before, activity, computed = entry
+        # Without O_NOATIME our own header read bumps the atime, that doesn't count as the server reading the region
+        atime_ns = atime_before if st.st_atime_ns == atime_after else st.st_atime_ns
+        return self.decay(now - st.st_mtime) + self.decay(now - atime_ns / 1e9) + activity * self.decay(now - computed)
+
+    def forget_missing(self, paths):
+        for path in set(self.headers) - set(paths):
+            del self.headers[path]
+
+def scan_regions(server_dir):
+    # name, path, stat of the region (of the target for symlinks), whether it's on the SSD
+    regions = []
+    with os.scandir(server_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".linear"):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError: # Dangling symlink, verify_ssd_storage.py reports those
+                continue
+            regions.append((entry.name, entry.path, st, not entry.is_symlink()))
+    return regions
+
+def plan_moves(regions, heats, ssd_bytes):
+    # The hottest regions that fit in ssd_bytes stay on or come to the SSD, everything else goes to storage
+    ranked = sorted(regions, key=lambda region: heats[region[0]] * (STICKINESS if region[3] else 1), reverse=True)
+    promotions = []
+    demotions = []
+    used = 0
+    full = False
+    for name, path, st, on_ssd in ranked:
+        if not full and used + st.st_size <= ssd_bytes:
+            used += st.st_size
+            if not on_ssd:
+                promotions.append((name, st.st_size))
+        else:
+            full = True
+            if on_ssd:
+                demotions.append((name, st.st_size))
+    return promotions, demotions
+
+def run_pass(args, tracker, throttle):
+    now = time.time()
+    regions = scan_regions(args.server_dir)
+    tracker.forget_missing([path for _, path, _, _ in regions])
+    heats = dict((name, tracker.heat(path, st, now)) for name, path, st, _ in regions)
+    promotions, demotions = plan_moves(regions, heats, args.ssd_size)
+
+    ssd_usage = sum(st.st_size for _, _, st, on_ssd in regions if on_ssd)
+    projected = ssd_usage + sum(size for _, size in promotions) - sum(size for _, size in demotions)
+    print("%d regions, SSD usage %.2f GB, projected %.2f GB of %.2f GB, %d to promote, %d to demote" % (len(regions), ssd_usage / 2**30, projected / 2**30, args.ssd_size / 2**30, len(promotions), len(demotions)))
+
+    if args.dry_run:
+        for name, size in demotions:
+            print("demote  %-24s %10.1f MB heat %.3f" % (name, size / 2**20, heats[name]))
+        for name, size in promotions:
+            print("promote %-24s %10.1f MB heat %.3f" % (name, size / 2**20, heats[name]))
+        return
+
+    def demote(task):
+        server_path, storage_path = os.path.join(args.server_dir, task[0]), os.path.join(args.storage_dir, task[0])
+        try:
+            up_to_date = is_same_file(os.stat(server_path), os.stat(storage_path))
+        except FileNotFoundError:
+            up_to_date = False
+        if not up_to_date:
+            copy_file(server_path, storage_path, throttle)
+        return "demoted" if swap_to_symlink(server_path, storage_path, throttle) else "changed"
+
+    def promote(task):
+        return "promoted" if swap_to_file(os.path.join(args.server_dir, task[0]), throttle) else "changed"
+
+    # Demotions first, they make room for the promotions
+    results = Counter()
+    if demotions:
+        results.update(run_tasks(demotions, demote, args.workers, desc="Demoting files", verbose=args.verbose))
+    if promotions and not results["interrupted"]:
+        results.update(run_tasks(promotions, promote, args.workers, desc="Promoting files", verbose=args.verbose))
+    print(f"Demoted {results['demoted']}, promoted {results['promoted']}, changed during the move {results['changed']}, failed {results['error']}")
+    if results["interrupted"]:
+        raise KeyboardInterrupt
+
+def main(args):
+    if not os.path.isdir(args.server_dir):
+        raise ValueError(f"Server directory {args.server_dir} does not exist or is not a directory.")
+    if not os.path.isdir(args.storage_dir):
+        raise ValueError(f"Storage directory {args.storage_dir} does not exist or is not a directory.")
+    if not args.dry_run:
+        clean_temporaries(args.server_dir)
+        clean_temporaries(args.storage_dir)
+
+    tracker = HeatTracker(args.half_life * 86400)
+    throttle = Throttle(args.max_mbps, args.max_iops)
+    try:
+        while True:
+            run_pass(args, tracker, throttle)
+            if args.once or args.dry_run:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    parser = CustomArgumentParser(description="Keep the hottest region files on the SSD and the rest as symlinks to storage.")
+    parser.add_argument("server_dir", help="minecraft server's region file directory (SSD)")
+    parser.add_argument("storage_dir", help="region file storage directory (HDD)")
+    parser.add_argument("-s", "--ssd-size", type=parse_size, required=True, help="Region bytes to keep on the SSD, accepts K/M/G/T suffixes")
+    parser.add_argument("--half-life", type=float, default=7, help="Days after which a write, read or chunk save counts half as much (default: 7)")
+    parser.add_argument("--interval", type=float, default=3600, help="Seconds between passes (default: 3600)")
+    parser.add_argument("--once", action="store_true", help="Run a single pass and exit")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Print the planned moves and the projected SSD usage without moving anything")
+    parser.add_argument("-v", "--verbose", action="store_true", help="verbose output")
+    add_tiering_arguments(parser)
+    args = parser.parse_args()
+    try:
+        main(args)
+    except ValueError as e:
+        parser.error(str(e))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import random
+import argparse
+import pyzstd
+from glob import glob
+from tqdm import tqdm
+from linear import iter_chunks_linear, iter_chunks_anvil, load_dictionary
+
+class CustomArgumentParser(argparse.ArgumentParser):
+    def error(self, _):
+        self.print_help()
+        sys.exit(1)
+
+def iter_chunks(file_path, zstd_dict):
+    if file_path.endswith(".linear"):
+        return iter_chunks_linear(file_path, zstd_dict)
+    return iter_chunks_anvil(file_path)
+
+def sample_chunks(file_list, sample_count, seed, zstd_dict):
+    # Reservoir sampling, so every chunk of the world has the same chance no matter how full its region is
+    rng = random.Random(seed)
+    samples = []
+    seen = 0
+    for file_path in tqdm(file_list, desc="Sampling chunks"):
+        try:
+            for chunk, _ in iter_chunks(file_path, zstd_dict):
+                seen += 1
+                if len(samples) < sample_count:
+                    samples.append(bytes(chunk.raw_chunk))
+                else:
+                    i = rng.randrange(seen)
+                    if i < sample_count:
+                        samples[i] = bytes(chunk.raw_chunk)
+        except Exception:
+            print("Error with region file", file_path)
+    return samples, seen
+
+def main(args):
+    file_list = glob(os.path.join(args.source_dir, "*.linear")) + glob(os.path.join(args.source_dir, "*.mca"))
+    rng = random.Random(args.seed)
+    rng.shuffle(file_list)
+    if args.max_files:
+        file_list = file_list[:args.max_files]
+    print("Found", len(file_list), "region files to sample")
+
+    zstd_dict = load_dictionary(args.current_dictionary) if args.current_dictionary else None
+    samples, seen = sample_chunks(file_list, args.samples, args.seed, zstd_dict)
+    if not samples:
+        print("No chunks found")
+        sys.exit(1)
+    print("Training on", len(samples), "of", seen, "chunks,", sum(len(sample) for sample in samples) // 1024, "KiB")
+
+    zstd_dict = pyzstd.train_dict(samples, args.size)
+    with open(args.output + ".wip", "wb") as f:
+        f.write(zstd_dict.dict_content)
+    os.rename(args.output + ".wip", args.output)
+    print("Dictionary %d written to %s, %d bytes" % (zstd_dict.dict_id, args.output, len(zstd_dict.dict_content)))
+
+if __name__ == "__main__":
+    parser = CustomArgumentParser(description="Train a zstd dictionary on chunks sampled from a world")
+    parser.add_argument("-s", "--samples", type=int, default=20000, help="Number of chunks to sample (default: 20000)")
+    parser.add_argument("-S", "--size", type=int, default=112640, help="Dictionary size in bytes (default: 112640)")
+    parser.add_argument("-m", "--max-files", type=int, default=0, help="Only sample this many random region files (default: all)")
+    parser.add_argument("-d", "--current-dictionary", help="Dictionary the sampled .linear files were compressed with")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for sampling (default: 0)")
+    parser.add_argument("source_dir", help="Directory containing .linear or .mca region files")
+    parser.add_argument("output", help="Path of the dictionary file to write")
+
+    args = parser.parse_args()
+    main(args)
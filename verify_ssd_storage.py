@@ -1,43 +1,172 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import os
 import sys
+import time
+from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
+from linear import verify_linear, load_dictionary
+
+zstd_dict = None
 
 class CustomArgumentParser(argparse.ArgumentParser):
     def error(self, _):
         self.print_help()
         sys.exit(1)
 
+def init_worker(dictionary_path):
+    global zstd_dict
+    if dictionary_path:
+        zstd_dict = load_dictionary(dictionary_path)
+
 def main():
     parser = CustomArgumentParser(description='Compare server_dir and storage_dir')
     parser.add_argument('server_dir', help='Path to server directory')
     parser.add_argument('storage_dir', help='Path to storage directory')
     parser.add_argument('-v', '--verbose', action='store_true', help='Print missing files')
+    parser.add_argument('--deep', action='store_true', help='Also decompress every region file on both tiers and check signatures, zstd checksums and chunk counts')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(), help='Processes for --deep (default: number of CPUs)')
+    parser.add_argument('-m', '--max-mbps', type=float, default=0, help='Read at most this many MB/s in --deep, so it can run next to a live server (default: unlimited)')
+    parser.add_argument('-d', '--dictionary', help='Zstd dictionary the .linear files were compressed with')
+    parser.add_argument('-r', '--report', help='Write a JSON report of missing, corrupt and mismatched files to this path')
     args = parser.parse_args()
 
-    server_files = get_files(args.server_dir)
-    storage_files = get_files(args.storage_dir)
+    server_entries = get_entries(args.server_dir)
+    storage_entries = get_entries(args.storage_dir)
+    server_files = set(server_entries)
+    storage_files = set(storage_entries)
 
     missing_files = find_missing_files(server_files, storage_files)
+    dangling_symlinks, mismatches = find_mismatches(server_entries, storage_entries)
 
     if args.verbose:
         print_missing_files(missing_files)
+        for mismatch in mismatches:
+            print("Mismatch:", mismatch["name"], "server %d bytes %.0f," % (mismatch["server_size"], mismatch["server_mtime"]), "storage %d bytes %.0f" % (mismatch["storage_size"], mismatch["storage_mtime"]))
+
+    corrupt_files = []
+    verified_files, verified_bytes = 0, 0
+    if args.deep:
+        files = files_to_verify(server_entries, storage_entries)
+        corrupt_files = verify_files(files, args.processes, args.max_mbps, args.dictionary)
+        verified_files, verified_bytes = len(files), sum(size for _, size in files)
+        for corrupt in corrupt_files:
+            print("Corrupt:", corrupt["path"], "-", corrupt["error"])
 
     print_statistics(len(server_files), len(storage_files), len(missing_files))
+    print("Dangling symlinks: ", len(dangling_symlinks))
+    print("Size or mtime mismatches: ", len(mismatches))
+    if args.deep:
+        print("Verified files: ", verified_files, "(%.1f MB)" % (verified_bytes / 2**20))
+        print("Corrupt files: ", len(corrupt_files))
 
-    if len(missing_files) > 0:
-        print("\033[31mMissing region files found\033[0m")
+    if args.report:
+        report = {
+            "server_dir": args.server_dir,
+            "storage_dir": args.storage_dir,
+            "deep": args.deep,
+            "server_files": len(server_files),
+            "storage_files": len(storage_files),
+            "missing": sorted(missing_files),
+            "dangling_symlinks": sorted(dangling_symlinks),
+            "mismatches": mismatches,
+            "verified_files": verified_files,
+            "verified_bytes": verified_bytes,
+            "corrupt": corrupt_files,
+        }
+        with open(args.report + ".wip", "w") as f:
+            json.dump(report, f, indent=2)
+        os.rename(args.report + ".wip", args.report)
+
+    if len(missing_files) > 0 or len(dangling_symlinks) > 0 or len(corrupt_files) > 0:
+        if missing_files: print("\033[31mMissing region files found\033[0m")
+        if dangling_symlinks: print("\033[31mDangling symlinks found\033[0m")
+        if corrupt_files: print("\033[31mCorrupt region files found\033[0m")
         sys.exit(1)
     else:
         print("\033[32mServer healthy\033[0m")
 
-def get_files(dir_path):
-    files = [f for f in os.listdir(dir_path) if f.endswith('.linear')]
-    return set(files)
+def get_entries(dir_path):
+    with os.scandir(dir_path) as entries:
+        return dict((entry.name, entry) for entry in entries if entry.name.endswith('.linear'))
 
 def find_missing_files(server_files, storage_files):
     return storage_files.difference(server_files)
 
+def find_mismatches(server_entries, storage_entries):
+    # A server copy that differs from its storage copy is only a stale storage copy, free_ssd_storage.py won't swap it.
+    # A symlink whose target differs from the storage copy points somewhere unexpected
+    dangling_symlinks = []
+    mismatches = []
+    for name, server_entry in sorted(server_entries.items()):
+        try:
+            server_stat = os.stat(server_entry.path)
+        except FileNotFoundError:
+            dangling_symlinks.append(name)
+            continue
+        storage_entry = storage_entries.get(name)
+        if storage_entry is None or not storage_entry.is_file():
+            continue
+        storage_stat = storage_entry.stat()
+        if server_entry.is_symlink() and os.path.samestat(server_stat, storage_stat):
+            continue
+        if server_stat.st_size != storage_stat.st_size or server_stat.st_mtime != storage_stat.st_mtime:
+            mismatches.append({
+                "name": name,
+                "server_path": os.path.realpath(server_entry.path),
+                "storage_path": storage_entry.path,
+                "symlink": server_entry.is_symlink(),
+                "server_size": server_stat.st_size,
+                "server_mtime": server_stat.st_mtime,
+                "storage_size": storage_stat.st_size,
+                "storage_mtime": storage_stat.st_mtime,
+            })
+    return dangling_symlinks, mismatches
+
+def files_to_verify(server_entries, storage_entries):
+    # Every real file once, symlinks on the server mostly point at files that are verified on the storage side anyway
+    files = {}
+    for entry in list(server_entries.values()) + list(storage_entries.values()):
+        try:
+            st = os.stat(entry.path)
+        except FileNotFoundError:
+            continue
+        files.setdefault((st.st_dev, st.st_ino), (os.path.realpath(entry.path), st.st_size))
+    return sorted(files.values())
+
+def throttled(files, max_mbps):
+    # Hands out files no faster than the limit allows, the pool reads them as they come
+    start = time.time()
+    submitted = 0
+    for path, size in files:
+        if max_mbps > 0:
+            delay = submitted / (max_mbps * 2**20) - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        submitted += size
+        yield path, size
+
+def verify_file(args):
+    path, size = args
+    try:
+        verify_linear(path, size, deep=True, zstd_dict=zstd_dict)
+        return path, size, None
+    except Exception as e:
+        return path, size, str(e) or type(e).__name__
+
+def verify_files(files, processes, max_mbps, dictionary_path):
+    corrupt_files = []
+    with Pool(processes, initializer=init_worker, initargs=(dictionary_path,)) as pool:
+        progress_bar = tqdm(total=sum(size for _, size in files), desc="Verifying files", unit="B", unit_scale=True, unit_divisor=1024)
+        for path, size, error in pool.imap_unordered(verify_file, throttled(files, max_mbps), chunksize=1):
+            if error is not None:
+                corrupt_files.append({"path": path, "size": size, "error": error})
+            progress_bar.update(size)
+        progress_bar.close()
+    corrupt_files.sort(key=lambda corrupt: corrupt["path"])
+    return corrupt_files
+
 def print_missing_files(missing_files):
     print("Missing files:")
     for f in missing_files: